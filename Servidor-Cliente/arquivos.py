@@ -0,0 +1,311 @@
+"""Transferência de arquivos fora do fluxo de mensagens do chat.
+
+Uploads e downloads usam uma porta própria (FILE_PORT). Cada requisição é uma
+linha JSON seguida dos bytes do arquivo:
+
+- UPLOAD {"op", "token", "sha256", "size"} -> {"status": "READY", "offset"} e o
+  cliente envia os bytes a partir de `offset` (retomada), ou {"status": "EXISTS"}
+  se o conteúdo já está no repositório. Ao fim: {"status": "DONE", "file_id"}.
+- DOWNLOAD {"op", "token", "file_id", "offset"} -> {"status": "OK", "size"} e
+  os bytes a partir de `offset`, enviados com sendfile.
+
+Os arquivos ficam num repositório endereçado pelo SHA-256 do conteúdo, então
+o mesmo arquivo enviado várias vezes ocupa o disco uma vez só. No chat vai
+apenas a referência {"id", "name", "size"}.
+"""
+import hashlib
+import hmac
+import json
+import logging
+import os
+import re
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+FILE_PORT = 54322
+STORE_DIR = 'arquivos'
+CHUNK_SIZE = 64 * 1024
+MAX_FILE_SIZE = 100 * 1024 * 1024
+MAX_HEADER_SIZE = 4096
+FILE_TOKEN_TTL = 24 * 3600
+FILE_WORKERS = 8
+
+_FILE_ID = re.compile(r'^[0-9a-f]{64}$')
+
+
+def is_file_id(value):
+    return isinstance(value, str) and bool(_FILE_ID.match(value))
+
+
+def make_file_token(secret, username, ttl=FILE_TOKEN_TTL):
+    expires = int(time.time()) + ttl
+    payload = f"{username}:{expires}"
+    signature = hmac.new(secret, payload.encode('utf-8'), hashlib.sha256).hexdigest()
+    return f"{payload}:{signature}"
+
+
+def verify_file_token(secret, token):
+    """Retorna o usuário dono do token, ou None se inválido/expirado."""
+    try:
+        username, expires, signature = str(token).rsplit(':', 2)
+        expected = hmac.new(secret, f"{username}:{expires}".encode('utf-8'), hashlib.sha256).hexdigest()
+        if hmac.compare_digest(signature, expected) and int(expires) > time.time():
+            return username
+    except ValueError:
+        pass
+    return None
+
+
+def sha256_file(path, limit=None):
+    digest = hashlib.sha256()
+    remaining = limit
+    with open(path, 'rb') as f:
+        while remaining is None or remaining > 0:
+            chunk = f.read(CHUNK_SIZE if remaining is None else min(CHUNK_SIZE, remaining))
+            if not chunk: break
+            digest.update(chunk)
+            if remaining is not None: remaining -= len(chunk)
+    return digest.hexdigest()
+
+
+def _read_line(sock, buffer=b""):
+    while b'\n' not in buffer:
+        if len(buffer) > MAX_HEADER_SIZE:
+            raise ValueError("Cabeçalho grande demais.")
+        data = sock.recv(MAX_HEADER_SIZE)
+        if not data:
+            raise ConnectionError("Conexão encerrada.")
+        buffer += data
+    line, rest = buffer.split(b'\n', 1)
+    return json.loads(line.decode('utf-8')), rest
+
+
+def _send_line(sock, data):
+    sock.sendall((json.dumps(data) + '\n').encode('utf-8'))
+
+
+class FileStore:
+    """Repositório em disco: arquivos/ab/abcdef... e uploads parciais em arquivos/tmp."""
+
+    def __init__(self, root=STORE_DIR):
+        self.root = root
+        self.tmp = os.path.join(root, 'tmp')
+        os.makedirs(self.tmp, exist_ok=True)
+
+    def path(self, file_id):
+        return os.path.join(self.root, file_id[:2], file_id)
+
+    def part_path(self, file_id):
+        return os.path.join(self.tmp, file_id + '.part')
+
+    def exists(self, file_id):
+        return is_file_id(file_id) and os.path.isfile(self.path(file_id))
+
+    def size(self, file_id):
+        return os.path.getsize(self.path(file_id))
+
+    def commit(self, file_id):
+        """Confere o hash do upload completo e move para o lugar definitivo."""
+        part = self.part_path(file_id)
+        if sha256_file(part) != file_id:
+            os.remove(part)
+            return False
+        os.makedirs(os.path.dirname(self.path(file_id)), exist_ok=True)
+        os.replace(part, self.path(file_id))
+        return True
+
+
+class FileServer:
+    def __init__(self, store, secret, host, port=FILE_PORT, reuse_port=False, tls_context=None):
+        self.store = store
+        self.tls_context = tls_context
+        self.secret = secret
+        self.address = (host, port)
+        self.upload_locks = {}
+        self.running = False
+        self.locks_lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=FILE_WORKERS, thread_name_prefix='FileThread')
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+    def start(self, bind=True):
+        """Com bind=False o socket de escuta veio pronto de outro processo (hot restart)."""
+        if bind:
+            self.server_socket.bind(self.address)
+            self.server_socket.listen()
+        # Com timeout o accept confere `running`: após uma troca de processo o socket de
+        # escuta continua aberto no processo novo e este não pode mais aceitar nele
+        self.server_socket.settimeout(1.0)
+        self.running = True
+        threading.Thread(target=self._accept_loop, name="FileServerThread", daemon=True).start()
+        logging.info(f"Servidor de arquivos em {self.address[0]}:{self.address[1]}")
+
+    def close(self):
+        self.running = False
+        try: self.server_socket.close()
+        except OSError: pass
+        self.executor.shutdown(wait=False)
+
+    def _accept_loop(self):
+        while self.running:
+            try:
+                conn, _ = self.server_socket.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            self.executor.submit(self._handle, conn)
+
+    def _handle(self, conn):
+        try:
+            conn.settimeout(60.0)
+            if self.tls_context:
+                conn = self.tls_context.wrap_socket(conn, server_side=True)
+            request, rest = _read_line(conn)
+            username = verify_file_token(self.secret, request.get('token'))
+            if not username:
+                _send_line(conn, {"status": "ERROR", "message": "Token inválido."})
+            elif request.get('op') == 'UPLOAD':
+                self._upload(conn, username, request, rest)
+            elif request.get('op') == 'DOWNLOAD':
+                self._download(conn, request)
+            else:
+                _send_line(conn, {"status": "ERROR", "message": "Operação desconhecida."})
+        except (OSError, ValueError, ConnectionError) as e:
+            logging.warning(f"Transferência de arquivo interrompida: {e}", extra={"category": "arquivo"})
+        finally:
+            conn.close()
+
+    def _claim_upload(self, file_id):
+        """Lock do upload deste arquivo, já adquirido; None se outro upload dele está em andamento."""
+        with self.locks_lock:
+            lock = self.upload_locks.setdefault(file_id, threading.Lock())
+            return lock if lock.acquire(blocking=False) else None
+
+    def _release_upload(self, file_id, lock):
+        # Soltar e remover juntos: ninguém pega um lock que já saiu do dicionário
+        with self.locks_lock:
+            lock.release()
+            if self.upload_locks.get(file_id) is lock: del self.upload_locks[file_id]
+
+    def _upload(self, conn, username, request, rest):
+        file_id, size = request.get('sha256'), request.get('size')
+        if not is_file_id(file_id) or not isinstance(size, int) or not 0 < size <= MAX_FILE_SIZE:
+            _send_line(conn, {"status": "ERROR", "message": f"Arquivo inválido (máximo {MAX_FILE_SIZE // (1024 * 1024)} MB)."})
+            return
+        if self.store.exists(file_id):
+            _send_line(conn, {"status": "EXISTS", "file_id": file_id})
+            return
+        lock = self._claim_upload(file_id)
+        if lock is None:
+            _send_line(conn, {"status": "ERROR", "message": "Upload deste arquivo já em andamento."})
+            return
+        try:
+            part = self.store.part_path(file_id)
+            offset = min(os.path.getsize(part), size) if os.path.exists(part) else 0
+            _send_line(conn, {"status": "READY", "offset": offset})
+            with open(part, 'ab') as f:
+                f.truncate(offset)
+                received = offset
+                data = rest
+                while True:
+                    if data:
+                        data = data[:size - received]
+                        f.write(data)
+                        received += len(data)
+                    if received >= size: break
+                    data = conn.recv(CHUNK_SIZE)
+                    if not data:
+                        raise ConnectionError(f"upload parado em {received}/{size} bytes")
+            if self.store.commit(file_id):
+                logging.info(f"Arquivo {file_id[:12]} ({size} bytes) recebido de {username}.", extra={"category": "arquivo", "user": username})
+                _send_line(conn, {"status": "DONE", "file_id": file_id})
+            else:
+                _send_line(conn, {"status": "ERROR", "message": "Conteúdo não confere com o hash."})
+        finally:
+            self._release_upload(file_id, lock)
+
+    def _download(self, conn, request):
+        file_id, offset = request.get('file_id'), request.get('offset', 0)
+        if not self.store.exists(file_id):
+            _send_line(conn, {"status": "ERROR", "message": "Arquivo não encontrado."})
+            return
+        size = self.store.size(file_id)
+        offset = max(0, min(int(offset), size))
+        _send_line(conn, {"status": "OK", "size": size})
+        with open(self.store.path(file_id), 'rb') as f:
+            # socket.sendfile usa os.sendfile quando disponível: o kernel copia
+            # do cache de página direto para o socket, sem passar pelo Python
+            # (sob TLS os dados precisam ser cifrados e ele volta a usar send)
+            conn.sendfile(f, offset)
+
+
+def _connect(host, port, tls_context=None):
+    sock = socket.create_connection((host, port), timeout=30)
+    if not tls_context: return sock
+    try:
+        return tls_context.wrap_socket(sock, server_hostname=host)
+    except Exception:
+        sock.close()
+        raise
+
+
+def upload_file(host, port, token, path, attempts=3, tls_context=None):
+    """Envia o arquivo (retomando de onde parou em caso de queda); retorna o file_id."""
+    file_id, size = sha256_file(path), os.path.getsize(path)
+    for attempt in range(1, attempts + 1):
+        try:
+            with _connect(host, port, tls_context) as sock:
+                _send_line(sock, {"op": "UPLOAD", "token": token, "sha256": file_id, "size": size})
+                response, _ = _read_line(sock)
+                if response.get('status') == 'EXISTS': return file_id
+                if response.get('status') != 'READY':
+                    raise ValueError(response.get('message', 'Upload recusado.'))
+                with open(path, 'rb') as f:
+                    sock.sendfile(f, response['offset'])
+                response, _ = _read_line(sock)
+                if response.get('status') != 'DONE':
+                    raise ValueError(response.get('message', 'Upload falhou.'))
+                return file_id
+        except (OSError, ConnectionError) as e:
+            if attempt == attempts: raise
+            logging.warning(f"Upload interrompido ({e}); retomando.")
+            time.sleep(attempt)
+
+
+def download_file(host, port, token, file_id, dest, attempts=3, tls_context=None):
+    """Baixa para `dest`, retomando de `dest + '.part'` se já houver parte baixada."""
+    part = dest + '.part'
+    for attempt in range(1, attempts + 1):
+        try:
+            offset = os.path.getsize(part) if os.path.exists(part) else 0
+            with _connect(host, port, tls_context) as sock:
+                _send_line(sock, {"op": "DOWNLOAD", "token": token, "file_id": file_id, "offset": offset})
+                response, data = _read_line(sock)
+                if response.get('status') != 'OK':
+                    raise ValueError(response.get('message', 'Download recusado.'))
+                size = response['size']
+                with open(part, 'ab') as f:
+                    f.truncate(offset)
+                    received = offset
+                    while True:
+                        if data:
+                            f.write(data)
+                            received += len(data)
+                        if received >= size: break
+                        data = sock.recv(CHUNK_SIZE)
+                        if not data:
+                            raise ConnectionError(f"download parado em {received}/{size} bytes")
+            if sha256_file(part) != file_id:
+                os.remove(part)
+                raise ValueError("Arquivo baixado não confere com o hash.")
+            os.replace(part, dest)
+            return dest
+        except (OSError, ConnectionError) as e:
+            if attempt == attempts: raise
+            logging.warning(f"Download interrompido ({e}); retomando.")
+            time.sleep(attempt)
@@ -0,0 +1,178 @@
+"""Barramento entre os processos do servidor no modo multiprocesso.
+
+Cada worker se conecta ao broker por um socket Unix e troca eventos JSON por
+linha. O broker mantém o diretório usuário -> worker e roteia:
+
+- presence: {"op", "user", "online", "session"} -> repassado a todos os outros workers
+- deliver: {"op", "to", "message"} -> só ao worker onde `to` está online;
+  sem dono, volta ao remetente como "undeliverable"
+- publish: {"op", "message", "room"} -> todos os outros workers (room None = todos)
+- qualquer evento com "target" -> só ao worker indicado (ex.: claim/claimed)
+"""
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+
+BUS_SOCKET = 'chat_bus.sock'
+BUS_CONNECT_TIMEOUT = 10  # segundos esperando o broker subir
+BUS_REQUEST_TIMEOUT = 2.0
+
+
+def _send_line(conn, lock, event):
+    with lock:
+        conn.sendall((json.dumps(event) + '\n').encode('utf-8'))
+
+
+def _read_lines(conn):
+    buffer = b""
+    while True:
+        data = conn.recv(65536)
+        if not data: return
+        buffer += data
+        while b'\n' in buffer:
+            line, buffer = buffer.split(b'\n', 1)
+            if line.strip(): yield json.loads(line)
+
+
+class BusBroker:
+    def __init__(self, path=BUS_SOCKET):
+        self.path = path
+        self.workers = {}  # worker_id -> (conn, lock)
+        self.directory = {}  # username -> {'worker', 'online', 'session'}
+        self.lock = threading.Lock()
+        if os.path.exists(path): os.unlink(path)
+        self.server_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server_socket.bind(path)
+        self.server_socket.listen()
+
+    def serve_forever(self):
+        logging.info(f"Barramento escutando em {self.path}")
+        while True:
+            try:
+                conn, _ = self.server_socket.accept()
+            except OSError:
+                break
+            threading.Thread(target=self._handle_worker, args=(conn,), daemon=True, name="BusWorkerThread").start()
+
+    def close(self):
+        self.server_socket.close()
+        if os.path.exists(self.path): os.unlink(self.path)
+
+    def _handle_worker(self, conn):
+        worker_id, lock = None, threading.Lock()
+        try:
+            for event in _read_lines(conn):
+                if event.get('op') == 'hello':
+                    worker_id = event['worker']
+                    with self.lock:
+                        self.workers[worker_id] = (conn, lock)
+                        snapshot = [dict(info, op='presence', user=user) for user, info in self.directory.items()]
+                    for presence in snapshot:
+                        _send_line(conn, lock, presence)
+                    logging.info(f"Worker {worker_id} conectado ao barramento.")
+                elif worker_id is not None:
+                    self._route(worker_id, event)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Conexão do worker {worker_id} com o barramento falhou: {e}")
+        finally:
+            if worker_id is not None: self._drop_worker(worker_id)
+            conn.close()
+
+    def _route(self, origin, event):
+        op = event.get('op')
+        event['origin'] = origin
+        with self.lock:
+            if op == 'presence':
+                if event.get('online') or event.get('session'):
+                    self.directory[event['user']] = {'worker': origin, 'online': event.get('online', False), 'session': event.get('session')}
+                elif self.directory.get(event['user'], {}).get('worker') == origin:
+                    del self.directory[event['user']]
+            if 'target' in event:
+                targets = [event['target']]
+            elif op == 'deliver':
+                owner = self.directory.get(event['to'])
+                if owner and owner['online']:
+                    targets = [owner['worker']]
+                else:
+                    targets, event = [origin], {'op': 'undeliverable', 'message': event['message']}
+            else:
+                targets = [w for w in self.workers if w != origin]
+            conns = [self.workers[w] for w in targets if w in self.workers]
+        for conn, lock in conns:
+            try:
+                _send_line(conn, lock, event)
+            except OSError:
+                pass  # o _handle_worker daquele worker cuida da limpeza
+
+    def _drop_worker(self, worker_id):
+        with self.lock:
+            self.workers.pop(worker_id, None)
+            gone = [u for u, info in self.directory.items() if info['worker'] == worker_id]
+            for user in gone: del self.directory[user]
+        logging.warning(f"Worker {worker_id} saiu do barramento; {len(gone)} usuário(s) marcados offline.")
+        for user in gone:
+            self._route(worker_id, {'op': 'presence', 'user': user, 'online': False, 'session': None})
+
+
+class BusClient:
+    """Lado do worker. Eventos recebidos vão para `on_event` (a fila do servidor);
+    respostas a `request` são entregues direto a quem está esperando."""
+
+    def __init__(self, path, worker_id, on_event):
+        self.worker_id = worker_id
+        self.on_event = on_event
+        self.lock = threading.Lock()
+        self.pending = {}
+        deadline = time.time() + BUS_CONNECT_TIMEOUT
+        while True:
+            try:
+                self.conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self.conn.connect(path)
+                break
+            except OSError:
+                self.conn.close()
+                if time.time() > deadline: raise
+                time.sleep(0.1)
+        self.send({'op': 'hello', 'worker': worker_id})
+        threading.Thread(target=self._reader, daemon=True, name="BusReaderThread").start()
+
+    def send(self, event):
+        try:
+            _send_line(self.conn, self.lock, event)
+        except OSError as e:
+            logging.error(f"Falha ao publicar no barramento: {e}")
+
+    def request(self, event, timeout=BUS_REQUEST_TIMEOUT):
+        """Envia e espera o evento com `reply_to` correspondente; None em caso de timeout."""
+        request_id = uuid.uuid4().hex
+        waiter = {'event': threading.Event(), 'reply': None}
+        self.pending[request_id] = waiter
+        self.send(dict(event, request_id=request_id, reply_worker=self.worker_id))
+        waiter['event'].wait(timeout)
+        self.pending.pop(request_id, None)
+        return waiter['reply']
+
+    def reply(self, request, event):
+        self.send(dict(event, target=request['reply_worker'], reply_to=request['request_id']))
+
+    def _reader(self):
+        try:
+            for event in _read_lines(self.conn):
+                waiter = self.pending.get(event.get('reply_to'))
+                if waiter:
+                    waiter['reply'] = event
+                    waiter['event'].set()
+                elif 'reply_to' not in event:
+                    self.on_event(event)
+        except (OSError, ValueError) as e:
+            logging.error(f"Conexão com o barramento perdida: {e}")
+        else:
+            logging.error("Barramento encerrou a conexão.")
+
+    def close(self):
+        try: self.conn.close()
+        except OSError: pass
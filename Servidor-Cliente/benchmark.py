@@ -0,0 +1,225 @@
+"""Medições de desempenho do protocolo do chat, sem precisar subir o servidor.
+
+Uso: python benchmark.py {compressao,broadcast,tls} [opções]
+"""
+import argparse
+import json
+import os
+import random
+import socket
+import ssl
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from compressao import StreamCompressor, StreamDecompressor, COMPRESSION_THRESHOLD
+from transporte import enable_nodelay, encode_message
+from seguranca import client_context, generate_self_signed, server_context
+from servidor import ChatServer
+
+
+def _userlist_messages(n_users, count):
+    users = [f"usuario{i:05d}" for i in range(n_users)]
+    for _ in range(count):
+        online = set(random.sample(users, n_users // 10))
+        yield encode_message({"type": "USERLIST", "users": [f"{u}:{'online' if u in online else 'offline'}" for u in users]})
+
+
+def _room_messages(count):
+    senders = [f"usuario{i:03d}" for i in range(50)]
+    words = "oi tudo bem alguém viu a aula de redes hoje o trabalho é para sexta socket tcp".split()
+    for _ in range(count):
+        text = " ".join(random.choices(words, k=random.randint(3, 20)))
+        yield encode_message({"type": "ROOM_MESSAGE", "sender": random.choice(senders), "room": "Geral",
+                     "message": text, "timestamp": datetime.now().strftime('%H:%M:%S'), "seq": random.randint(1, 10**6)})
+
+
+def bench_compressao(args):
+    scenarios = [
+        (f"USERLIST ({args.users} usuários)", list(_userlist_messages(args.users, 50))),
+        ("Sala movimentada", list(_room_messages(args.messages))),
+    ]
+    print(f"Limite de compressão: {args.threshold} bytes\n")
+    print(f"{'Cenário':<28}{'Original':>12}{'Enviado':>12}{'Economia':>10}{'Comprimir':>14}{'Descomprimir':>15}")
+    for name, payloads in scenarios:
+        encoder = StreamCompressor(threshold=args.threshold)
+        decoder = StreamDecompressor()
+        start = time.perf_counter()
+        frames = [encoder.encode(p) for p in payloads]
+        t_encode = time.perf_counter() - start
+        start = time.perf_counter()
+        decoded = [decoder.feed(f) for f in frames]
+        t_decode = time.perf_counter() - start
+        assert decoded == payloads
+        raw, sent = encoder.bytes_in, encoder.bytes_out
+        print(f"{name:<28}{raw:>12,}{sent:>12,}{1 - sent / raw:>10.1%}"
+              f"{t_encode / len(payloads) * 1e6:>11.1f} µs{t_decode / len(payloads) * 1e6:>12.1f} µs")
+
+
+class _SinkSocket:
+    """Socket de mentira que só conta syscalls e bytes, para isolar o custo em Python."""
+
+    def __init__(self):
+        self.calls = 0
+        self.bytes = 0
+
+    def sendall(self, data):
+        self.calls += 1
+        self.bytes += len(data)
+
+    def sendmsg(self, buffers):
+        self.calls += 1
+        sent = sum(len(b) for b in buffers)
+        self.bytes += sent
+        return sent
+
+
+def bench_broadcast(args):
+    messages = list(_room_messages(args.burst))
+    messages = [json.loads(m) for m in messages]
+
+    def antigo(socks):
+        # Como era: json.dumps + encode por destinatário e um sendall por mensagem
+        start = time.process_time()
+        for msg in messages:
+            for sock in socks:
+                sock.sendall((json.dumps(msg) + '\n').encode('utf-8'))
+        return time.process_time() - start
+
+    def novo(socks):
+        # O caminho real do servidor: broadcast -> send_bytes (acumula na thread da fila)
+        # -> flush_writes, com os sockets de mentira no lugar dos clientes.
+        # ChatServer cria o banco e o repositório de arquivos no diretório atual
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            try:
+                server = ChatServer()
+            finally:
+                os.chdir(cwd)
+        server.clients = {sock: {'username': f"usuario{i}", 'last_ping': 0, 'rooms': {'Geral'}} for i, sock in enumerate(socks)}
+        cpu = []
+
+        def burst():
+            start = time.process_time()
+            for msg in messages:
+                server.broadcast(msg)
+            server.flush_writes()
+            cpu.append(time.process_time() - start)
+
+        server.message_worker = threading.Thread(target=burst, name="MessageQueueThread")
+        server.message_worker.start()
+        server.message_worker.join()
+        server.server_socket.close()
+        server.file_server.close()
+        server.executor.shutdown()
+        return cpu[0]
+
+    print(f"Rajada de {args.burst} mensagem(ns) para {args.members:,} membros\n")
+    print(f"{'Versão':<10}{'CPU total':>12}{'CPU/broadcast':>16}{'syscalls':>12}{'bytes':>14}")
+    for name, func in (("antigo", antigo), ("novo", novo)):
+        socks = [_SinkSocket() for _ in range(args.members)]
+        cpu = func(socks)
+        print(f"{name:<10}{cpu * 1e3:>9.1f} ms{cpu / args.burst * 1e3:>13.2f} ms"
+              f"{sum(s.calls for s in socks):>12,}{sum(s.bytes for s in socks):>14,}")
+
+
+def _tls_responder(context):
+    """Servidor mínimo: handshake, lê uma linha, responde e fecha. Sem bcrypt nem banco,
+    para que o tempo medido seja o do TLS."""
+    listener = socket.create_server(('127.0.0.1', 0), backlog=1024)
+
+    def handle(conn):
+        # Como no servidor de verdade: sem Nagle, a resposta curta não espera o ACK atrasado
+        enable_nodelay(conn)
+        try:
+            with context.wrap_socket(conn, server_side=True) as tls:
+                tls.recv(4096)
+                tls.sendall(b'{"status": "SUCCESS"}\n')
+        except OSError:
+            conn.close()
+
+    def accept_loop():
+        while True:
+            try:
+                conn, _ = listener.accept()
+            except OSError:
+                break
+            threading.Thread(target=handle, args=(conn,), daemon=True).start()
+
+    threading.Thread(target=accept_loop, daemon=True).start()
+    return listener
+
+
+def _reconnect(context, address, session):
+    """Uma reconexão: TCP + TLS + LOGIN + resposta. Retorna (tempo, retomada?, sessão nova)."""
+    start = time.perf_counter()
+    with socket.create_connection(address) as sock:
+        enable_nodelay(sock)
+        with context.wrap_socket(sock, server_hostname='localhost', session=session) as tls:
+            tls.sendall(b'{"action": "LOGIN"}\n')
+            tls.recv(4096)
+            return time.perf_counter() - start, tls.session_reused, tls.session
+
+
+def bench_tls(args):
+    versions = {"1.2": ssl.TLSVersion.TLSv1_2, "1.3": ssl.TLSVersion.TLSv1_3}
+    with tempfile.TemporaryDirectory() as tmp:
+        cert, key = os.path.join(tmp, 'cert.pem'), os.path.join(tmp, 'key.pem')
+        generate_self_signed(cert, key, key=args.chave)
+        print(f"Onda de {args.clients:,} reconexões ({args.concurrency} simultâneas), chave {args.chave.upper()}\n")
+        print(f"{'TLS':<6}{'Handshake':<12}{'Reconexões/s':>14}{'Média':>10}{'p99':>10}{'CPU/conexão':>14}{'Retomadas':>11}")
+        for name in args.versions:
+            server_ctx = server_context(cert, key, args.ciphers)
+            server_ctx.maximum_version = versions[name]
+            client_ctx = client_context(cert, args.ciphers)
+            client_ctx.maximum_version = versions[name]
+            listener = _tls_responder(server_ctx)
+            address = listener.getsockname()
+            # Cada cliente simulado já fez login uma vez e guardou a sua sessão
+            with ThreadPoolExecutor(args.concurrency) as pool:
+                sessions = [s for _, _, s in pool.map(lambda _: _reconnect(client_ctx, address, None), range(args.clients))]
+            for mode, use_session in (("completo", False), ("retomado", True)):
+                with ThreadPoolExecutor(args.concurrency) as pool:
+                    start, cpu = time.perf_counter(), time.process_time()
+                    results = list(pool.map(lambda s: _reconnect(client_ctx, address, s if use_session else None), sessions))
+                    wall, cpu = time.perf_counter() - start, time.process_time() - cpu
+                latencies = sorted(r[0] for r in results)
+                print(f"{name:<6}{mode:<12}{len(results) / wall:>14,.0f}{sum(latencies) / len(latencies) * 1e3:>7.2f} ms"
+                      f"{latencies[int(len(latencies) * 0.99) - 1] * 1e3:>7.2f} ms{cpu / len(results) * 1e6:>11.0f} µs"
+                      f"{sum(r[1] for r in results):>11,}")
+            listener.close()
+    print("\nCPU/conexão soma cliente e servidor (mesmo processo).")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    p = sub.add_parser("compressao", help="Banda economizada x custo de CPU da compressão por conexão")
+    p.add_argument("--users", type=int, default=1000)
+    p.add_argument("--messages", type=int, default=5000)
+    p.add_argument("--threshold", type=int, default=COMPRESSION_THRESHOLD)
+    p.set_defaults(func=bench_compressao)
+
+    p = sub.add_parser("broadcast", help="CPU por broadcast: serialização única e escrita vetorizada")
+    p.add_argument("--members", type=int, default=10000)
+    p.add_argument("--burst", type=int, default=10, help="mensagens enfileiradas antes da escrita")
+    p.set_defaults(func=bench_broadcast)
+
+    p = sub.add_parser("tls", help="Onda de reconexões: handshake TLS completo x retomado")
+    p.add_argument("--clients", type=int, default=500)
+    p.add_argument("--concurrency", type=int, default=32)
+    p.add_argument("--chave", choices=("ec", "rsa"), default="ec", help="tipo da chave do certificado gerado")
+    p.add_argument("--versions", nargs="+", choices=("1.2", "1.3"), default=["1.2", "1.3"])
+    p.add_argument("--ciphers", help="cifras do TLS 1.2, na sintaxe do OpenSSL")
+    p.set_defaults(func=bench_tls)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
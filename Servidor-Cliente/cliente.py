@@ -1,11 +1,25 @@
 import tkinter as tk
-from tkinter import scrolledtext, messagebox, ttk
+from tkinter import scrolledtext, messagebox, ttk, filedialog
 import socket
 import threading
 import json
 import time
 import queue
 import logging
+import uuid
+import os
+import zlib
+import argparse
+from collections import OrderedDict
+from compressao import COMPRESSION_METHODS, StreamDecompressor
+from transporte import enable_nodelay, fits_message
+from arquivos import download_file, upload_file
+from seguranca import client_context
+
+RECONNECT_DELAYS = (1, 2, 4, 8, 15, 30, 30, 30)  # segundos entre tentativas
+ACK_BATCH = 32  # mensagens recebidas antes de forçar um ACK
+ACK_DELAY = 0.5  # segundos que um ACK pode esperar por uma mensagem para pegar carona
+RELIABLE_TYPES = ("PUBLIC", "PRIVATE", "ROOM_MESSAGE")
 
 logging.basicConfig(
     level=logging.INFO,
@@ -16,8 +30,14 @@ logging.basicConfig(
     ]
 )
 
+def _format_size(size):
+    for unit in ("B", "KB", "MB"):
+        if size < 1024: return f"{size:.0f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GB"
+
 class ChatClient:
-    def __init__(self, root):
+    def __init__(self, root, tls_context=None):
         self.root = root
         self.root.title("Chat UABJ - Desconectado")
         self.root.geometry("800x600")
@@ -27,7 +47,29 @@ class ChatClient:
         self.port = 54321
         self.socket = None
         self.connected = False
+        self.reconnecting = False
         self.username = None
+        self.password = None
+        self.compression = None  # tk.BooleanVar criada na tela de login
+
+        # TLS: a sessão do último handshake é reapresentada na reconexão para
+        # o servidor retomá-la sem refazer a troca de chaves
+        self.tls_context = tls_context
+        self.tls_session = None
+
+        # Entrega confiável: cada mensagem enviada recebe um seq e fica em
+        # `unacked` até o servidor confirmar; recv_seq é o que já recebemos.
+        self.session_id = None
+        self.send_lock = threading.RLock()
+        self.out_seq = 0
+        self.unacked = OrderedDict()
+        self.recv_seq = 0
+        self.acked_recv_seq = 0
+        self.ack_timer = None
+
+        # Canal de arquivos: porta e token recebidos na resposta do login
+        self.file_port = None
+        self.file_token = None
         
         self.ui_queue = queue.Queue()
         
@@ -64,6 +106,8 @@ class ChatClient:
         ttk.Label(form_frame, text="Password:").grid(row=1, column=0, sticky='w', padx=5, pady=5)
         self.password_entry = ttk.Entry(form_frame, show="*", width=30)
         self.password_entry.grid(row=1, column=1, padx=5, pady=5)
+        self.compression = tk.BooleanVar(value=False)
+        ttk.Checkbutton(form_frame, text="Comprimir dados (conexões lentas/móveis)", variable=self.compression).grid(row=2, column=0, columnspan=2, sticky='w', padx=5, pady=5)
         button_frame = ttk.Frame(f)
         button_frame.pack(pady=20)
         self.login_button = ttk.Button(button_frame, text="Login", command=self.handle_login)
@@ -100,6 +144,8 @@ class ChatClient:
         self.message_entry.bind("<KeyPress>", self.handle_typing_start)
         self.send_button = ttk.Button(input_frame, text="Enviar", command=self.send_message)
         self.send_button.grid(row=0, column=1)
+        self.file_button = ttk.Button(input_frame, text="Arquivo", command=self.handle_attach)
+        self.file_button.grid(row=0, column=2, padx=(5, 0))
 
         right_panel = ttk.Frame(self.chat_frame)
         right_panel.grid(row=0, column=1, sticky='nsew', padx=5, pady=5)
@@ -137,14 +183,16 @@ class ChatClient:
         try:
             while not self.ui_queue.empty():
                 action, data = self.ui_queue.get_nowait()
-                if action == 'login_success': self._on_login_success(data['socket'])
+                if action == 'login_success': self._on_login_success(data['socket'], data['response'], data['pending'])
+                elif action == 'reconnected': self._on_reconnected(data['socket'], data['response'], data['pending'])
                 elif action == 'operation_failed':
                     messagebox.showerror("Erro", data['message'])
                     self.set_login_buttons_state('normal')
                 elif action == 'registration_success':
                     messagebox.showinfo("Info", data['message'])
                     self.set_login_buttons_state('normal')
-                elif action == 'display_message': self._display_message(data['target_tab'], data['text'])
+                elif action == 'display_message': self._display_message(data['target_tab'], data['text'], data.get('attachment'))
+                elif action == 'send_attachment': self._send_attachment(data['chat'], data['attachment'])
                 elif action == 'create_tab': self._create_chat_tab(data['name'])
                 elif action == 'update_users': self._update_user_list(data['users'])
                 elif action == 'update_typing': self.typing_label.config(text=data['text'])
@@ -155,21 +203,40 @@ class ChatClient:
     def _queue_ui_update(self, action, **kwargs):
         self.ui_queue.put((action, kwargs))
 
-    def _auth_thread(self, request):
+    def _handshake(self, request):
+        """Conecta, envia a requisição e lê a resposta; retorna também o que sobrou no buffer."""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             sock.settimeout(10)
             sock.connect((self.host, self.port))
+            enable_nodelay(sock)
+            if self.tls_context:
+                sock = self.tls_context.wrap_socket(sock, server_hostname=self.host, session=self.tls_session)
             
             sock.sendall((json.dumps(request) + '\n').encode('utf-8'))
             
-            response_data = sock.recv(4096).decode('utf-8')
-            if not response_data:
-                raise ConnectionError("Servidor não enviou resposta.")
-            response = json.loads(response_data.strip())
+            buffer = b""
+            while b'\n' not in buffer:
+                data = sock.recv(4096)
+                if not data:
+                    raise ConnectionError("Servidor não enviou resposta.")
+                buffer += data
+            line, pending = buffer.split(b'\n', 1)
+            if self.tls_context:
+                # Lida a resposta, os tickets do TLS 1.3 já chegaram e a sessão pode ser retomada
+                if sock.session_reused: logging.info("Sessão TLS retomada.")
+                self.tls_session = sock.session
+            return sock, json.loads(line.decode('utf-8')), pending
+        except Exception:
+            sock.close()
+            raise
+
+    def _auth_thread(self, request):
+        try:
+            sock, response, pending = self._handshake(request)
 
             if request['action'] == 'LOGIN' and response.get('status') == 'SUCCESS':
-                self._queue_ui_update('login_success', socket=sock)
+                self._queue_ui_update('login_success', socket=sock, response=response, pending=pending)
             else:
                 sock.close()
                 if response.get('status') == 'SUCCESS':
@@ -188,8 +255,21 @@ class ChatClient:
             messagebox.showerror("Erro", "Usuário e senha são obrigatórios.")
             return
 
+        self.password = password
+        with self.send_lock:
+            self.session_id = uuid.uuid4().hex
+            self.out_seq = self.recv_seq = self.acked_recv_seq = 0
+            self.unacked.clear()
+
         self.set_login_buttons_state('disabled')
-        threading.Thread(target=self._auth_thread, args=({"action": "LOGIN", "username": self.username, "password": password},), daemon=True, name="AuthThread").start()
+        threading.Thread(target=self._auth_thread, args=(self._login_request(),), daemon=True, name="AuthThread").start()
+
+    def _login_request(self):
+        request = {"action": "LOGIN", "username": self.username, "password": self.password,
+                   "session": self.session_id, "ack": self.recv_seq}
+        if self.compression is not None and self.compression.get():
+            request["compression"] = list(COMPRESSION_METHODS)
+        return request
 
     def handle_register(self):
         username = self.username_entry.get().strip()
@@ -201,8 +281,14 @@ class ChatClient:
         threading.Thread(target=self._auth_thread, args=({"action": "REGISTER", "username": username, "password": password},), daemon=True, name="AuthThread").start()
 
     def handle_logout(self, message="Você foi desconectado."):
-        if not self.connected: return
+        if not self.connected and not self.reconnecting: return
         self.connected = False
+        self.reconnecting = False
+        self.password = None
+        with self.send_lock:
+            self.unacked.clear()
+            if self.ack_timer: self.ack_timer.cancel()
+            self.ack_timer = None
         if self.socket:
             try:
                 self.socket.shutdown(socket.SHUT_RDWR)
@@ -211,11 +297,7 @@ class ChatClient:
                 logging.error(f"Erro ao fechar socket no logout: {e}")
         self._queue_ui_update('reset_to_login', message=message)
         
-    def _on_login_success(self, sock):
-        self.socket = sock
-        self.socket.settimeout(None)
-        self.connected = True
-        
+    def _on_login_success(self, sock, response, pending):
         self.login_frame.pack_forget()
         self.chat_frame.pack(fill=tk.BOTH, expand=True)
         self.root.title(f"Chat UABJ - {self.username}")
@@ -225,31 +307,122 @@ class ChatClient:
         
         self._create_chat_tab("Geral")
 
-        threading.Thread(target=self._receive_messages, daemon=True, name="ReceiverThread").start()
-        threading.Thread(target=self._ping_handler, daemon=True, name="PingThread").start()
-        
+        self._start_session(sock, response, pending)
+
+    def _on_reconnected(self, sock, response, pending):
+        if not self.reconnecting:
+            sock.close()
+            return
+        self._display_message("Geral", "[SISTEMA] Reconectado ao servidor.")
+        self._start_session(sock, response, pending)
+
+    def _start_session(self, sock, response, pending):
+        """Ativa a conexão recém-autenticada e reenvia o que o servidor ainda não confirmou."""
+        sock.settimeout(None)
+        self.file_port = response.get('file_port')
+        self.file_token = response.get('file_token')
+        with self.send_lock:
+            self.socket = sock
+            self.connected = True
+            self.reconnecting = False
+            self._process_ack(response.get('ack', 0))
+            replay = list(self.unacked.values())
+
+        decoder = StreamDecompressor() if response.get('compression') else None
+        threading.Thread(target=self._receive_messages, args=(sock, pending, decoder), daemon=True, name="ReceiverThread").start()
+        threading.Thread(target=self._ping_handler, args=(sock,), daemon=True, name="PingThread").start()
+
+        if replay: logging.info(f"Reenviando {len(replay)} mensagem(ns) não confirmada(s).")
+        for data in replay:
+            if not self._send_raw(sock, data): return
         self.send_json({"type": "USERLIST"})
 
-    def _receive_messages(self):
-        buffer = ""
-        while self.connected:
+    def _connection_lost(self, sock, reason):
+        """Fecha a conexão que caiu e inicia a reconexão automática."""
+        with self.send_lock:
+            if not self.connected or sock is not self.socket: return
+            self.connected = False
+            self.reconnecting = True
+        logging.warning(f"Conexão perdida ({reason}). Tentando reconectar.")
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+            sock.close()
+        except OSError:
+            pass
+        self._queue_ui_update('display_message', target_tab="Geral", text="[SISTEMA] Conexão perdida. Tentando reconectar...")
+        threading.Thread(target=self._reconnect_loop, daemon=True, name="ReconnectThread").start()
+
+    def _reconnect_loop(self):
+        for attempt, delay in enumerate(RECONNECT_DELAYS, 1):
+            time.sleep(delay)
+            if not self.reconnecting: return
+            try:
+                sock, response, pending = self._handshake(self._login_request())
+            except (OSError, ValueError) as e:
+                logging.warning(f"Tentativa de reconexão {attempt} falhou: {e}")
+                continue
+            if response.get('status') != 'SUCCESS':
+                logging.warning(f"Tentativa de reconexão {attempt} recusada: {response.get('message')}")
+                sock.close()
+                continue
+            self._queue_ui_update('reconnected', socket=sock, response=response, pending=pending)
+            return
+        if self.reconnecting:
+            self.reconnecting = False
+            self._queue_ui_update('reset_to_login', message="Não foi possível reconectar ao servidor.")
+
+    def _receive_messages(self, sock, pending=b"", decoder=None):
+        # Com compressão negociada, tudo após a resposta de login chega em frames
+        buffer = (decoder.feed(pending) if decoder else pending).decode('utf-8')
+        while self.connected and sock is self.socket:
             try:
-                data = self.socket.recv(4096)
-                if not data:
-                    raise ConnectionError("Servidor desconectou.")
-                
-                buffer += data.decode('utf-8')
                 while '\n' in buffer:
                     line, buffer = buffer.split('\n', 1)
                     if not line.strip(): continue
                     message = json.loads(line)
                     self.process_server_message(message)
-            except (ConnectionError, json.JSONDecodeError, OSError) as e:
+
+                data = sock.recv(4096)
+                if not data:
+                    raise ConnectionError("Servidor desconectou.")
+                if decoder: data = decoder.feed(data)
+                buffer += data.decode('utf-8')
+            except (ConnectionError, json.JSONDecodeError, OSError, ValueError, zlib.error) as e:
                 logging.error(f"Erro recebendo mensagens: {e}")
-                if self.connected: self.handle_logout("A conexão com o servidor foi perdida.")
+                self._connection_lost(sock, e)
                 break
 
+    def _track_sequence(self, msg):
+        """Registra o seq recebido; retorna False para mensagens já entregues antes."""
+        if "ack" in msg:
+            with self.send_lock:
+                self._process_ack(msg["ack"])
+        seq = msg.get("seq")
+        if seq is None: return True
+        with self.send_lock:
+            duplicate = seq <= self.recv_seq
+            if not duplicate: self.recv_seq = seq
+            if self.recv_seq - self.acked_recv_seq >= ACK_BATCH:
+                self._send_ack()
+            elif not self.ack_timer:
+                self.ack_timer = threading.Timer(ACK_DELAY, self._send_ack)
+                self.ack_timer.daemon = True
+                self.ack_timer.start()
+        return not duplicate
+
+    def _process_ack(self, ack):
+        while self.unacked and next(iter(self.unacked)) <= ack:
+            self.unacked.popitem(last=False)
+
+    def _send_ack(self):
+        with self.send_lock:
+            if self.ack_timer: self.ack_timer.cancel()
+            self.ack_timer = None
+            if self.recv_seq > self.acked_recv_seq:
+                self.send_json({"type": "ACK"})
+
     def process_server_message(self, msg):
+        if not self._track_sequence(msg): return
         msg_type = msg.get("type", "").lower()
         target_tab = "Geral"
         text = ""
@@ -267,7 +440,7 @@ class ChatClient:
             elif msg_type == "system":
                  text = f"[SISTEMA] {msg.get('message')}"
             
-            if text: self._queue_ui_update('display_message', target_tab=target_tab, text=text)
+            if text: self._queue_ui_update('display_message', target_tab=target_tab, text=text, attachment=msg.get('attachment'))
 
         elif msg_type == "userlist": self._queue_ui_update('update_users', users=msg.get("users", []))
         elif msg_type == "typing":
@@ -277,23 +450,45 @@ class ChatClient:
                 self._queue_ui_update('update_typing', text=status)
         elif msg_type == "pong": self.last_ping_time = time.time()
 
-    def _ping_handler(self):
+    def _ping_handler(self, sock):
         self.last_ping_time = time.time()
-        while self.connected:
+        while self.connected and sock is self.socket:
             time.sleep(self.ping_interval)
+            if sock is not self.socket: break
             if time.time() - self.last_ping_time > self.ping_interval * 1.5:
-                logging.warning("Não recebeu PONG do servidor, desconectando.")
-                self.handle_logout("Perda de conexão com o servidor (timeout).")
+                logging.warning("Não recebeu PONG do servidor, reconectando.")
+                self._connection_lost(sock, "timeout de PONG")
                 break
             if not self.send_json({"type": "PING"}): break
 
     def send_json(self, data):
-        if not self.connected or not self.socket: return False
+        """Envia ao servidor. Mensagens de chat ganham seq e ficam guardadas até o ACK,
+        então continuam valendo (retorna True) mesmo durante uma reconexão."""
+        reliable = data.get("type") in RELIABLE_TYPES
+        # O servidor descarta linhas grandes demais sem processar o seq, e a mensagem
+        # seria reenviada a cada reconexão: recusa antes de numerar
+        if not fits_message(data): return False
+        with self.send_lock:
+            if not self.connected and not (reliable and self.reconnecting): return False
+            if reliable:
+                self.out_seq += 1
+                data = dict(data, seq=self.out_seq)
+                self.unacked[self.out_seq] = data
+            if not self.connected: return True
+            # ACK pendente pega carona em qualquer mensagem que sair
+            if self.recv_seq > self.acked_recv_seq:
+                data = dict(data, ack=self.recv_seq)
+                self.acked_recv_seq = self.recv_seq
+            sock = self.socket
+            return self._send_raw(sock, data) or reliable
+
+    def _send_raw(self, sock, data):
         try:
-            self.socket.sendall((json.dumps(data) + '\n').encode('utf-8'))
+            with self.send_lock:
+                sock.sendall((json.dumps(data) + '\n').encode('utf-8'))
             return True
-        except (OSError, ConnectionError):
-            if self.connected: self.handle_logout("A conexão com o servidor foi perdida.")
+        except (OSError, ConnectionError) as e:
+            self._connection_lost(sock, e)
             return False
 
     def send_message(self, event=None):
@@ -302,19 +497,74 @@ class ChatClient:
 
         active_chat = self._get_active_chat_name()
         if not active_chat: return
+
+        if message.split()[0] == "/perfil":
+            # Comando de administrador: /perfil start|stop|dump (a resposta chega como SYSTEM)
+            action = message.split()[1] if len(message.split()) > 1 else "status"
+            if self.send_json({"type": "PROFILE", "action": action}):
+                self.message_entry.delete(0, tk.END)
+            return
         
         msg_data = {"message": message}
         if active_chat == "Geral":
             msg_data.update({"type": "PUBLIC", "message": message})
         else: # Chat Privado
             msg_data.update({"type": "PRIVATE", "recipient": active_chat})
-            text = f"<Você para {active_chat}>: {message}"
-            self._display_message(active_chat, text)
+        if not fits_message(msg_data):
+            self._display_message(active_chat, "[SISTEMA] Mensagem grande demais. Use o botão Arquivo para enviar textos longos.")
+            return
+        if msg_data["type"] == "PRIVATE":
+            self._display_message(active_chat, f"<Você para {active_chat}>: {message}")
         
         if self.send_json(msg_data):
             self.message_entry.delete(0, tk.END)
         self.handle_typing_stop()
 
+    def handle_attach(self):
+        active_chat = self._get_active_chat_name()
+        if not active_chat or not self.connected or not self.file_token: return
+        path = filedialog.askopenfilename(title="Enviar arquivo")
+        if not path: return
+        self._display_message(active_chat, f"[SISTEMA] Enviando {os.path.basename(path)}...")
+        threading.Thread(target=self._upload_thread, args=(active_chat, path), daemon=True, name="FileThread").start()
+
+    def _upload_thread(self, chat, path):
+        # O arquivo vai pelo canal próprio; no chat segue só a referência
+        try:
+            file_id = upload_file(self.host, self.file_port, self.file_token, path, tls_context=self.tls_context)
+        except (OSError, ValueError) as e:
+            logging.error(f"Falha no upload de {path}: {e}")
+            self._queue_ui_update('display_message', target_tab=chat, text=f"[SISTEMA] Falha ao enviar arquivo: {e}")
+            return
+        attachment = {"id": file_id, "name": os.path.basename(path), "size": os.path.getsize(path)}
+        self._queue_ui_update('send_attachment', chat=chat, attachment=attachment)
+
+    def _send_attachment(self, chat, attachment):
+        msg_data = {"message": f"[arquivo] {attachment['name']}", "attachment": attachment}
+        if chat == "Geral":
+            msg_data["type"] = "PUBLIC"
+        else:
+            msg_data.update({"type": "PRIVATE", "recipient": chat})
+        if not fits_message(msg_data):
+            self._display_message(chat, f"[SISTEMA] Nome de arquivo longo demais: {attachment['name'][:80]}...")
+            return
+        if msg_data["type"] == "PRIVATE":
+            self._display_message(chat, f"<Você para {chat}>: {msg_data['message']}", attachment)
+        self.send_json(msg_data)
+
+    def download_attachment(self, target_tab, attachment):
+        dest = filedialog.asksaveasfilename(title="Salvar arquivo", initialfile=attachment.get('name'))
+        if not dest: return
+        def worker():
+            try:
+                download_file(self.host, self.file_port, self.file_token, attachment['id'], dest, tls_context=self.tls_context)
+                text = f"[SISTEMA] Arquivo salvo em {dest}"
+            except (OSError, ValueError) as e:
+                logging.error(f"Falha no download de {attachment['id']}: {e}")
+                text = f"[SISTEMA] Falha ao baixar arquivo: {e}"
+            self._queue_ui_update('display_message', target_tab=target_tab, text=text)
+        threading.Thread(target=worker, daemon=True, name="FileThread").start()
+
     def start_private_chat(self, event=None):
         selection = self.users_listbox.curselection()
         if not selection: return
@@ -426,10 +676,17 @@ class ChatClient:
             return None
         return None
 
-    def _display_message(self, target_tab, message):
+    def _display_message(self, target_tab, message, attachment=None):
         if target_tab in self.chat_tabs:
             display_widget = self.chat_tabs[target_tab]["display"]
             display_widget.config(state='normal')
+            if attachment:
+                tag = f"file-{attachment['id'][:16]}-{display_widget.index(tk.END)}"
+                display_widget.insert(tk.END, message + " ")
+                display_widget.insert(tk.END, f"[baixar, {_format_size(attachment.get('size', 0))}]", (tag,))
+                display_widget.tag_config(tag, foreground="blue", underline=True)
+                display_widget.tag_bind(tag, "<Button-1>", lambda e, a=attachment: self.download_attachment(target_tab, a))
+                message = ""
             display_widget.insert(tk.END, message + "\n")
             display_widget.config(state='disabled')
             display_widget.see(tk.END)
@@ -479,6 +736,12 @@ class ChatClient:
         self.root.destroy()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cliente do chat")
+    parser.add_argument("--tls", action="store_true", help="conecta com TLS")
+    parser.add_argument("--tls-ca", help="CA (PEM) para verificar o servidor; padrão: CAs do sistema")
+    parser.add_argument("--tls-ciphers", help="cifras aceitas no TLS 1.2, na sintaxe do OpenSSL")
+    args = parser.parse_args()
+
     root = tk.Tk()
-    client = ChatClient(root)
+    client = ChatClient(root, client_context(args.tls_ca, args.tls_ciphers) if args.tls or args.tls_ca else None)
     root.mainloop()
\ No newline at end of file
@@ -0,0 +1,69 @@
+import struct
+import zlib
+
+# Métodos que o servidor aceita, em ordem de preferência
+COMPRESSION_METHODS = ("deflate",)
+COMPRESSION_THRESHOLD = 64  # bytes; PONG, ACK e typing seguem sem compressão
+COMPRESSION_LEVEL = 6
+
+# Depois de negociada a compressão, o fluxo servidor -> cliente deixa de ser
+# JSON por linha e passa a ser uma sequência de frames: tipo (1 byte) + tamanho
+# (4 bytes) + conteúdo. O conteúdo, depois de descomprimido, são as mesmas
+# linhas JSON de sempre.
+FRAME_HEADER = struct.Struct('!BI')
+FRAME_RAW = 0
+FRAME_DEFLATE = 1
+
+
+def negotiate(offered):
+    """Escolhe o primeiro método oferecido pelo cliente que o servidor suporta."""
+    if not isinstance(offered, list): return None
+    for method in offered:
+        if method in COMPRESSION_METHODS:
+            return method
+    return None
+
+
+class StreamCompressor:
+    """Contexto deflate por conexão: o dicionário é compartilhado entre as
+    mensagens, então chaves JSON e nomes repetidos custam quase nada."""
+
+    def __init__(self, threshold=COMPRESSION_THRESHOLD, level=COMPRESSION_LEVEL):
+        self.threshold = threshold
+        self._zlib = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def encode(self, payload):
+        if len(payload) < self.threshold:
+            frame = FRAME_HEADER.pack(FRAME_RAW, len(payload)) + payload
+        else:
+            # Z_SYNC_FLUSH fecha o bloco sem reiniciar o dicionário
+            body = self._zlib.compress(payload) + self._zlib.flush(zlib.Z_SYNC_FLUSH)
+            frame = FRAME_HEADER.pack(FRAME_DEFLATE, len(body)) + body
+        self.bytes_in += len(payload)
+        self.bytes_out += len(frame)
+        return frame
+
+
+class StreamDecompressor:
+    def __init__(self):
+        self._zlib = zlib.decompressobj(-zlib.MAX_WBITS)
+        self._buffer = b""
+
+    def feed(self, data):
+        """Recebe bytes do socket e devolve o conteúdo dos frames completos."""
+        self._buffer += data
+        out = []
+        while len(self._buffer) >= FRAME_HEADER.size:
+            kind, length = FRAME_HEADER.unpack_from(self._buffer)
+            end = FRAME_HEADER.size + length
+            if len(self._buffer) < end: break
+            body = self._buffer[FRAME_HEADER.size:end]
+            self._buffer = self._buffer[end:]
+            if kind == FRAME_DEFLATE:
+                body = self._zlib.decompress(body)
+            elif kind != FRAME_RAW:
+                raise ValueError(f"Tipo de frame desconhecido: {kind}")
+            out.append(body)
+        return b"".join(out)
@@ -0,0 +1,196 @@
+"""Profiling sob demanda do servidor, ligado por sinal (SIGUSR1) ou pelo comando
+PROFILE de um administrador, sem reiniciar o processo.
+
+Desligado, custa uma checagem de atributo por item da fila. Ligado:
+
+- uma thread amostra a pilha de todas as threads (sys._current_frames) a cada
+  PROFILE_INTERVAL e conta as pilhas repetidas;
+- cada tipo de mensagem acumula quantidade, tempo total e máximo do handler
+  (LOGIN/REGISTER também, por causa do bcrypt);
+- um handler acima de SLOW_HANDLER_THRESHOLD gera um trace com as etapas
+  enfileirado -> despachado -> persistido -> enviado.
+
+Ao parar, grava em PROFILE_DIR o arquivo .folded (pilhas no formato "collapsed"
+do flamegraph.pl e do speedscope) e um .json com os tempos e os traces lentos.
+"""
+import contextlib
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+PROFILE_DIR = 'perfil'
+PROFILE_INTERVAL = 0.005  # segundos entre amostras (200 por segundo)
+SLOW_HANDLER_THRESHOLD = 0.05  # segundos; handlers acima disso geram trace
+MAX_SLOW_TRACES = 500
+
+_OFF = contextlib.nullcontext()
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    name = getattr(code, 'co_qualname', code.co_name)
+    return f"{name} ({os.path.basename(code.co_filename)})".replace(';', ',')
+
+
+def collapse_stack(thread_name, frame):
+    """Pilha no formato collapsed: raiz primeiro, separada por ';'."""
+    names = []
+    while frame is not None:
+        names.append(_frame_name(frame))
+        frame = frame.f_back
+    names.append(thread_name.replace(';', ','))
+    return ';'.join(reversed(names))
+
+
+class Profiler:
+    def __init__(self, directory=PROFILE_DIR, interval=PROFILE_INTERVAL, threshold=SLOW_HANDLER_THRESHOLD):
+        self.directory = directory
+        self.interval = interval
+        self.threshold = threshold
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.local = threading.local()  # trace do item em andamento, por thread
+        self.sampler = None
+        self._reset()
+
+    def _reset(self):
+        self.stacks = Counter()
+        self.samples = 0
+        self.timings = {}  # rótulo -> [quantidade, total, máximo]
+        self.slow = []
+        self.unsent = []  # traces lentos aguardando a escrita nos sockets
+        self.started = time.time()
+
+    def start(self):
+        with self.lock:
+            if self.enabled: return False
+            self._reset()
+            self.enabled = True
+            self.sampler = threading.Thread(target=self._sample_loop, name="ProfilerThread", daemon=True)
+            self.sampler.start()
+        logging.info(f"Profiling ligado (amostra a cada {self.interval * 1000:.0f} ms, trace acima de {self.threshold * 1000:.0f} ms).",
+                     extra={"category": "perfil"})
+        return True
+
+    def stop(self):
+        """Desliga e grava os resultados; retorna o caminho do .folded (None se já estava desligado)."""
+        with self.lock:
+            if not self.enabled: return None
+            self.enabled = False
+            sampler = self.sampler
+        if sampler is not threading.current_thread(): sampler.join()
+        return self.dump()
+
+    def toggle(self):
+        if self.enabled: self.stop()
+        else: self.start()
+
+    def handle_signal(self, signum, frame):
+        # O handler roda na thread principal no meio de qualquer código (até com o
+        # lock da fila de log tomado); o trabalho de verdade vai para outra thread
+        threading.Thread(target=self.toggle, name="ProfilerToggleThread", daemon=True).start()
+
+    def _sample_loop(self):
+        me = threading.get_ident()
+        while self.enabled:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            stacks = [collapse_stack(names.get(ident, str(ident)), frame)
+                      for ident, frame in sys._current_frames().items() if ident != me]
+            with self.lock:
+                self.stacks.update(stacks)
+                self.samples += 1
+            time.sleep(self.interval)
+
+    # --- Tempos e traces (chamados pelo servidor só quando `enabled`) ---
+
+    def enqueued(self, item):
+        item['enqueued_at'] = time.perf_counter()
+
+    def begin(self, label, item):
+        self.local.trace = {'type': label, 'user': item.get('username'), 'enqueued': item.get('enqueued_at'),
+                            'dispatched': time.perf_counter(), 'persist': 0.0}
+
+    def span(self, name):
+        """Soma o tempo do bloco na etapa `name` do trace em andamento nesta thread."""
+        if not self.enabled or getattr(self.local, 'trace', None) is None: return _OFF
+        return self._span(self.local.trace, name)
+
+    @contextlib.contextmanager
+    def _span(self, trace, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            trace[name] = trace.get(name, 0.0) + time.perf_counter() - start
+
+    def end(self):
+        trace, self.local.trace = getattr(self.local, 'trace', None), None
+        if trace is None: return
+        trace['handled'] = time.perf_counter()
+        elapsed = trace['handled'] - trace['dispatched']
+        self.record(trace['type'], elapsed)
+        if elapsed >= self.threshold: self.unsent.append(trace)
+
+    def flushed(self):
+        """Chamado quando não há mais escrita pendente: fecha os traces lentos com a etapa de envio."""
+        if not self.unsent: return
+        now = time.perf_counter()
+        for trace in self.unsent:
+            entry = {'type': trace['type'], 'user': trace['user'],
+                     'fila_ms': (trace['dispatched'] - trace['enqueued']) * 1000 if trace['enqueued'] else None,
+                     'handler_ms': (trace['handled'] - trace['dispatched']) * 1000,
+                     'persist_ms': trace['persist'] * 1000,
+                     'envio_ms': (now - trace['handled']) * 1000,
+                     'total_ms': (now - (trace['enqueued'] or trace['dispatched'])) * 1000}
+            logging.warning(f"Handler lento: {entry['type']} de {entry['user']} levou {entry['handler_ms']:.1f} ms "
+                            f"(fila {entry['fila_ms'] or 0:.1f}, banco {entry['persist_ms']:.1f}, envio {entry['envio_ms']:.1f}).",
+                            extra={"category": "perfil", "user": entry['user']})
+            with self.lock:
+                if len(self.slow) < MAX_SLOW_TRACES: self.slow.append(entry)
+        self.unsent = []
+
+    def timed(self, label):
+        """Mede um bloco fora da fila (ex.: bcrypt no login, nas threads de cliente)."""
+        if not self.enabled: return _OFF
+        return self._timed(label)
+
+    @contextlib.contextmanager
+    def _timed(self, label):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(label, time.perf_counter() - start)
+
+    def record(self, label, elapsed):
+        with self.lock:
+            entry = self.timings.setdefault(label, [0, 0.0, 0.0])
+            entry[0] += 1
+            entry[1] += elapsed
+            entry[2] = max(entry[2], elapsed)
+
+    def dump(self):
+        """Grava o que foi coletado até agora (pode ser chamado com o profiling ligado)."""
+        os.makedirs(self.directory, exist_ok=True)
+        base = os.path.join(self.directory, f"perfil-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}")
+        with self.lock:
+            stacks = self.stacks.most_common()
+            timings = {label: {'quantidade': n, 'total_ms': total * 1000, 'media_ms': total / n * 1000, 'max_ms': peak * 1000}
+                       for label, (n, total, peak) in self.timings.items()}
+            report = {'inicio': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+                      'duracao_s': time.time() - self.started, 'amostras': self.samples,
+                      'intervalo_s': self.interval, 'limite_lento_ms': self.threshold * 1000,
+                      'tempos': timings, 'lentos': list(self.slow)}
+        with open(base + '.folded', 'w', encoding='utf-8') as f:
+            f.writelines(f"{stack} {count}\n" for stack, count in stacks)
+        with open(base + '.json', 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        top = sorted(timings.items(), key=lambda kv: kv[1]['total_ms'], reverse=True)[:5]
+        summary = ", ".join(f"{label} {t['total_ms']:.0f} ms/{t['quantidade']}" for label, t in top)
+        logging.info(f"Profiling gravado em {base}.folded ({self.samples} amostras). Mais custosos: {summary or 'nenhum'}.",
+                     extra={"category": "perfil"})
+        return base + '.folded'
@@ -0,0 +1,121 @@
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+
+LOG_FILE = 'chat_server.log'
+LOG_MAX_BYTES = 5 * 1024 * 1024
+LOG_BACKUPS = 5
+LOG_QUEUE_SIZE = 10000
+CONSOLE_FORMAT = '%(asctime)s - %(processName)s/%(threadName)s - %(levelname)s - [%(category)s] %(message)s'
+
+# Eventos por segundo (com rajada igual ao dobro) para as categorias mais falantes.
+# Categorias fora desta tabela não são limitadas; ERROR ou pior nunca é descartado.
+LOG_RATE_LIMITS = {
+    'conexao': 20.0,
+    'userlist': 1.0,
+    'entrega': 5.0,
+    'envio': 5.0,
+    'perfil': 5.0,  # avisos de handler lento; os traces completos vão para o arquivo do profiling
+}
+
+# Campos que vão para o registro estruturado quando passados em `extra`
+STRUCTURED_FIELDS = ('category', 'user', 'address', 'seq', 'count')
+
+
+class RateLimitFilter(logging.Filter):
+    """Token bucket por categoria. Roda na thread que loga, então o registro
+    descartado nem chega a entrar na fila."""
+
+    def __init__(self, limits):
+        super().__init__()
+        self.limits = limits
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if not hasattr(record, 'category'): record.category = 'geral'
+        rate = self.limits.get(record.category)
+        if rate is None or record.levelno >= logging.ERROR: return True
+        now = time.monotonic()
+        with self.lock:
+            tokens, last, suppressed = self.buckets.get(record.category, (rate * 2, now, 0))
+            tokens = min(rate * 2, tokens + (now - last) * rate)
+            if tokens < 1:
+                self.buckets[record.category] = (tokens, now, suppressed + 1)
+                return False
+            self.buckets[record.category] = (tokens - 1, now, 0)
+        if suppressed: record.suppressed = suppressed
+        return True
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """Com a fila cheia o registro é descartado (e contado) em vez de travar quem logou."""
+
+    _exc_formatter = logging.Formatter()
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def prepare(self, record):
+        # O QueueHandler padrão junta o traceback na mensagem; aqui ele vai formatado
+        # em exc_text (o traceback em si não pode ficar para outra thread), e cada
+        # formatter decide onde colocá-lo: o JSON no campo 'exc', o console no fim
+        record = copy.copy(record)
+        record.msg = record.message = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = self._exc_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+            'level': record.levelname,
+            'process': record.processName,
+            'thread': record.threadName,
+            'msg': record.getMessage(),
+        }
+        for field in STRUCTURED_FIELDS + ('suppressed',):
+            if hasattr(record, field): entry[field] = getattr(record, field)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text: entry['exc'] = record.exc_text
+        if record.stack_info: entry['stack'] = record.stack_info
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def setup_logging(level=logging.INFO, log_file=LOG_FILE, rate_limits=LOG_RATE_LIMITS):
+    """Configura o log assíncrono: as threads do servidor só enfileiram; uma
+    thread de log escreve no arquivo (JSON por linha, com rotação) e no console.
+    Retorna o QueueListener, que deve ser parado (stop) no encerramento."""
+    file_handler = logging.handlers.RotatingFileHandler(log_file, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS, encoding='utf-8')
+    file_handler.setFormatter(JsonFormatter())
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(logging.Formatter(CONSOLE_FORMAT))
+
+    queue_handler = NonBlockingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    queue_handler.addFilter(RateLimitFilter(rate_limits))
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+
+    listener = logging.handlers.QueueListener(queue_handler.queue, file_handler, console_handler)
+    listener.start()
+    return listener
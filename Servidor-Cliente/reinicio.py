@@ -0,0 +1,82 @@
+"""Troca de processo sem derrubar conexões (hot restart).
+
+O servidor em execução escuta em HANDOFF_SOCKET. Um processo novo iniciado com
+`--takeover` conecta ali e recebe:
+
+1. o estado (JSON com tamanho na frente): clientes, salas, sessões...
+2. os descritores de arquivo (socket de escuta, socket de arquivos e um por
+   cliente), em lotes via SCM_RIGHTS;
+
+e responde HANDOFF_ACK quando já assumiu tudo. Só então o processo antigo fecha
+as suas cópias (sem shutdown, que derrubaria a conexão) e sai.
+"""
+import json
+import socket
+import struct
+
+HANDOFF_SOCKET = 'chat_handoff.sock'
+HANDOFF_ACK = b'OK\n'
+HANDOFF_TIMEOUT = 30
+MAX_FDS_PER_MESSAGE = 200  # o Linux aceita até 253 por mensagem (SCM_MAX_FD)
+LENGTH = struct.Struct('!I')
+PEERCRED = struct.Struct('3i')  # struct ucred: pid, uid, gid
+
+
+def handoff_supported():
+    return hasattr(socket, 'AF_UNIX') and hasattr(socket, 'send_fds')
+
+
+def peer_uid(conn):
+    """Usuário do processo do outro lado do socket Unix (SO_PEERCRED); None se o
+    sistema não informa, e aí vale só a permissão 0600 do arquivo."""
+    if not hasattr(socket, 'SO_PEERCRED'): return None
+    _, uid, _ = PEERCRED.unpack(conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, PEERCRED.size))
+    return uid
+
+
+def _recv_exact(conn, size):
+    data = b""
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Conexão de troca encerrada no meio da transferência.")
+        data += chunk
+    return data
+
+
+def send_state(conn, state, fds):
+    payload = json.dumps(dict(state, fd_count=len(fds))).encode('utf-8')
+    conn.sendall(LENGTH.pack(len(payload)) + payload)
+    for i in range(0, len(fds), MAX_FDS_PER_MESSAGE):
+        batch = fds[i:i + MAX_FDS_PER_MESSAGE]
+        socket.send_fds(conn, [LENGTH.pack(len(batch))], batch)
+
+
+def wait_ack(conn):
+    conn.settimeout(HANDOFF_TIMEOUT)
+    try:
+        return _recv_exact(conn, len(HANDOFF_ACK)) == HANDOFF_ACK
+    except (OSError, ConnectionError):
+        return False
+
+
+def receive_state(path=HANDOFF_SOCKET):
+    """Lado do processo novo: retorna (conexão, estado, fds). A conexão fica
+    aberta para o HANDOFF_ACK ser enviado depois que o estado for adotado."""
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.settimeout(HANDOFF_TIMEOUT)
+    conn.connect(path)
+    try:
+        size, = LENGTH.unpack(_recv_exact(conn, LENGTH.size))
+        state = json.loads(_recv_exact(conn, size).decode('utf-8'))
+        fds = []
+        while len(fds) < state['fd_count']:
+            msg, batch, _, _ = socket.recv_fds(conn, LENGTH.size, MAX_FDS_PER_MESSAGE)
+            if not msg:
+                raise ConnectionError("Processo antigo encerrou antes de enviar os descritores.")
+            if len(msg) < LENGTH.size: _recv_exact(conn, LENGTH.size - len(msg))
+            fds.extend(batch)
+        return conn, state, fds
+    except Exception:
+        conn.close()
+        raise
@@ -0,0 +1,106 @@
+"""TLS opcional para o chat e para o canal de arquivos.
+
+O custo do TLS está quase todo no handshake completo (troca de chaves e
+verificação do certificado). Numa onda de reconexões isso se repete para cada
+cliente, então o servidor emite tickets de sessão e o cliente guarda a sessão
+do último login: na reconexão o handshake é retomado (resumption), sem refazer
+a parte cara. Veja `python benchmark.py tls`.
+"""
+import select
+import socket
+import ssl
+import subprocess
+import threading
+import time
+
+TLS_MIN_VERSION = ssl.TLSVersion.TLSv1_2
+TLS_TICKETS = 2  # tickets de sessão por handshake TLS 1.3
+TLS_HANDSHAKE_TIMEOUT = 10.0
+
+
+class LockedSSLSocket(ssl.SSLSocket):
+    """SSLSocket que pode ser lido por uma thread e escrito por outras.
+
+    Um objeto SSL do OpenSSL não aceita SSL_read e SSL_write ao mesmo tempo, e é
+    assim que o chat usa as conexões: a thread do cliente lê enquanto a fila de
+    mensagens escreve (no cliente, a leitura contra a interface, o ping e o ACK).
+    Toda operação TLS passa por um lock da conexão. A leitura não segura o lock
+    esperando dados: tenta sem bloquear e, se não há registro completo, espera
+    com select fora do lock, respeitando o timeout do socket.
+
+    `read_wait` limita só a espera das leituras (os envios seguem com o timeout do
+    socket): o servidor usa para um registro TLS incompleto não prender a thread
+    de leitura, que precisa voltar a conferir a troca de processo.
+    """
+
+    read_wait = None
+
+    @classmethod
+    def _create(cls, *args, **kwargs):
+        # SSLSocket não passa pelo __init__; o lock só é usado depois do handshake
+        sock = super()._create(*args, **kwargs)
+        sock._io_lock = threading.RLock()
+        return sock
+
+    def read(self, len=1024, buffer=None):
+        timeout = self.gettimeout()
+        limits = [t for t in (timeout, self.read_wait) if t is not None]
+        deadline = time.monotonic() + min(limits) if limits else None
+        while True:
+            with self._io_lock:
+                self.settimeout(0)
+                try:
+                    return super().read(len, buffer)
+                except ssl.SSLWantReadError:
+                    readable, writable = [self], []
+                except ssl.SSLWantWriteError:
+                    readable, writable = [], [self]
+                finally:
+                    self.settimeout(timeout)
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            if not any(select.select(readable, writable, [], remaining)):
+                raise socket.timeout("The read operation timed out")
+
+    def send(self, data, flags=0):
+        with self._io_lock:
+            return super().send(data, flags)
+
+    def sendall(self, data, flags=0):
+        # O lock vale para a mensagem inteira, não só para cada pedaço do send
+        with self._io_lock:
+            return super().sendall(data, flags)
+
+    def pending(self):
+        with self._io_lock:
+            return super().pending()
+
+
+def server_context(certfile, keyfile=None, ciphers=None, tickets=TLS_TICKETS):
+    """`ciphers` segue a sintaxe do OpenSSL e vale para TLS 1.2; as suítes do
+    TLS 1.3 são as padrão do OpenSSL."""
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = TLS_MIN_VERSION
+    context.load_cert_chain(certfile, keyfile)
+    if ciphers: context.set_ciphers(ciphers)
+    context.options &= ~ssl.OP_NO_TICKET
+    context.num_tickets = tickets
+    context.sslsocket_class = LockedSSLSocket
+    return context
+
+
+def client_context(cafile=None, ciphers=None):
+    """Sem `cafile` o certificado do servidor é verificado contra as CAs do sistema."""
+    context = ssl.create_default_context(cafile=cafile)
+    context.minimum_version = TLS_MIN_VERSION
+    if ciphers: context.set_ciphers(ciphers)
+    context.sslsocket_class = LockedSSLSocket
+    return context
+
+
+def generate_self_signed(certfile, keyfile, hostname='localhost', days=365, key='ec'):
+    """Certificado autoassinado para uso local (`key`: 'ec' = ECDSA P-256, 'rsa' = RSA 2048).
+    Requer o openssl de linha de comando."""
+    newkey = ['-newkey', 'ec', '-pkeyopt', 'ec_paramgen_curve:prime256v1'] if key == 'ec' else ['-newkey', 'rsa:2048']
+    subprocess.run(['openssl', 'req', '-x509', *newkey, '-nodes', '-keyout', keyfile, '-out', certfile,
+                    '-days', str(days), '-subj', f'/CN={hostname}', '-addext', f'subjectAltName=DNS:{hostname},IP:127.0.0.1'],
+                   check=True, capture_output=True)
@@ -5,9 +5,25 @@ import logging
 from datetime import datetime
 import bcrypt
 import json
+import os
 import time
 import queue
+import argparse
+import signal
+import secrets
+import select
+import ssl
+import multiprocessing
+from collections import OrderedDict
 from concurrent.futures import ThreadPoolExecutor
+from compressao import StreamCompressor, negotiate
+from transporte import MAX_MESSAGE_SIZE, encode_message, enable_nodelay, write_frames
+from registro import setup_logging
+from barramento import BUS_SOCKET, BusBroker, BusClient
+from arquivos import FILE_PORT, STORE_DIR, FileServer, FileStore, make_file_token
+from reinicio import HANDOFF_ACK, HANDOFF_SOCKET, handoff_supported, peer_uid, receive_state, send_state, wait_ack
+from seguranca import TLS_HANDSHAKE_TIMEOUT, LockedSSLSocket, server_context
+from perfil import Profiler
 
 DB_FILE = 'chat1.db'
 SERVER_HOST = 'localhost'
@@ -16,24 +32,46 @@ MAX_CONNECTIONS = 100
 BUFFER_SIZE = 8192
 PING_INTERVAL = 30
 PING_TIMEOUT = 1800  # 30 minutos
-
-logging.basicConfig(
-    level=logging.INFO, 
-    format='%(asctime)s - %(threadName)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('chat_server.log', mode='w'),
-        logging.StreamHandler()
-    ]
-)
+ACK_DELAY = 0.2  # segundos que um ACK pode esperar para ser agrupado
+SESSION_TTL = 300  # tempo que uma sessão desconectada aguarda a reconexão
+WRITE_BATCH = 64  # itens da fila processados antes de forçar a escrita nos sockets
+HANDOFF_POLL = 1.0  # intervalo em que leituras e accept conferem se há troca de processo
+HANDOFF_WAIT = 5.0  # espera máxima por logins em andamento e pela fila durante a troca
+# Tipos que process_client_message trata; o profiling agrupa o resto em "OUTRO" para
+# um cliente não criar rótulos à vontade
+CLIENT_MESSAGE_TYPES = frozenset(("PING", "ACK", "USERLIST", "PUBLIC", "PRIVATE", "ROOM_MESSAGE", "TYPING_START", "TYPING_STOP", "PROFILE"))
 
 class ChatServer:
-    def __init__(self):
+    def __init__(self, reuse_port=False, bus_path=None, worker_id=None, file_secret=None, handoff_path=None, tls_context=None, admins=()):
         self.rooms = {"Geral": set()}
         self.clients = {}
         self.clients_lock = threading.RLock()
+        self.sessions = {}
+        self.pending_acks = set()
+        self.last_ack_flush = time.time()
+        self.codecs = {}
+        self.pending_writes = {}
+        # Modo multiprocesso: usuários conectados aos outros workers, vindos do barramento
+        self.worker_id = worker_id
+        self.bus_path = bus_path
+        self.bus = None
+        self.remote_users = {}
         self.message_queue = queue.Queue()
         self.executor = ThreadPoolExecutor(max_workers=20, thread_name_prefix='ClientThread')
         self.running = False
+        self.tls_context = tls_context
+        self.admins = set(admins)
+        self.profiler = Profiler()
+        # Hot restart: o processo antigo "drena" (para de ler e aceitar) e entrega os sockets
+        self.handoff_path = handoff_path
+        self.handoff_listener = None
+        self.draining = False
+        self.handed_off = False
+        self.adopted_listener = False
+        self.adopted = []  # conexões recebidas do processo antigo, retomadas no start_server
+        self.loops_lock = threading.Lock()
+        self.active_loops = 0
+        self.authenticating = 0
 
         self.ping_interval = PING_INTERVAL
         self.ping_timeout = PING_TIMEOUT
@@ -42,7 +80,15 @@ class ChatServer:
         
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            # Vários workers escutam a mesma porta; o kernel distribui as conexões
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         
+        # Em modo multiprocesso o segredo é o mesmo em todos os workers, então
+        # qualquer um deles aceita o token de arquivo emitido no login
+        self.file_secret = file_secret or secrets.token_bytes(32)
+        self.file_server = FileServer(FileStore(STORE_DIR), self.file_secret, SERVER_HOST, FILE_PORT, reuse_port=reuse_port, tls_context=tls_context)
+
         self.message_worker = threading.Thread(target=self.process_message_queue, name="MessageQueueThread", daemon=True)
         self.cleanup_thread = threading.Thread(target=self.cleanup_connections, name="CleanupThread", daemon=True)
 
@@ -57,39 +103,74 @@ class ChatServer:
             conn.execute('''CREATE TABLE IF NOT EXISTS chat_history (
                 id INTEGER PRIMARY KEY AUTOINCREMENT, room TEXT, sender TEXT NOT NULL,
                 message TEXT NOT NULL, timestamp TEXT NOT NULL)''')
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(offline_messages)")]
+            if 'attachment' not in columns:
+                conn.execute("ALTER TABLE offline_messages ADD COLUMN attachment TEXT")
         logging.info("Banco de dados inicializado.")
 
     def start_server(self):
         try:
-            self.server_socket.bind((SERVER_HOST, SERVER_PORT))
-            self.server_socket.listen(MAX_CONNECTIONS)
+            if self.adopted_listener:
+                self.file_server.start(bind=False)
+            else:
+                self.server_socket.bind((SERVER_HOST, SERVER_PORT))
+                self.server_socket.listen(MAX_CONNECTIONS)
+                self.file_server.start()
+            self.server_socket.settimeout(HANDOFF_POLL)
             self.running = True
+            if self.bus_path:
+                self.bus = BusClient(self.bus_path, self.worker_id, lambda event: self.add_to_queue({'type': 'bus_event', 'event': event}))
             self.message_worker.start()
             self.cleanup_thread.start()
-            logging.info(f"Servidor iniciado em {SERVER_HOST}:{SERVER_PORT}")
+            if self.handoff_path: self.start_handoff_listener()
+            for client_socket, address, username, buffer in self.adopted:
+                self._submit_reader(client_socket, address, username, buffer)
+            logging.info(f"Servidor iniciado em {SERVER_HOST}:{SERVER_PORT}" + (" com TLS" if self.tls_context else "")
+                         + (f" ({len(self.adopted)} conexões herdadas)" if self.adopted_listener else ""))
+            self.adopted = []
             while self.running:
-                client_socket, address = self.server_socket.accept()
-                logging.info(f"Nova conexão de {address}")
+                if self.draining:
+                    time.sleep(0.05); continue
+                try:
+                    client_socket, address = self.server_socket.accept()
+                except socket.timeout:
+                    continue
+                enable_nodelay(client_socket)
+                logging.info(f"Nova conexão de {address}", extra={"category": "conexao", "address": str(address)})
                 self.executor.submit(self.handle_client, client_socket, address)
         except OSError as e:
             if self.running: logging.error(f"Erro de Socket: {e}")
         finally:
             self.stop_server()
 
-    def handle_client(self, client_socket, address):
-        username = None
+    def handle_client(self, client_socket, address, username=None, buffer=""):
+        parked = False
         try:
-            username = self._authentication_loop(client_socket)
+            if self.tls_context and username is None:
+                # Handshake aqui e não no accept: um cliente lento não segura os demais
+                client_socket.settimeout(TLS_HANDSHAKE_TIMEOUT)
+                try:
+                    client_socket = self.tls_context.wrap_socket(client_socket, server_side=True)
+                except (ssl.SSLError, socket.timeout) as e:
+                    logging.warning(f"Handshake TLS com {address} falhou: {e}", extra={"category": "conexao", "address": str(address)})
+                    client_socket.close()
+                    return
+            if username is None:
+                username = self._authenticate(client_socket)
             if username:
-                self._message_loop(client_socket, username)
+                parked = self._message_loop(client_socket, username, buffer)
         except (ConnectionResetError, ConnectionAbortedError):
-            logging.warning(f"Conexão com {address} (usuário: {username}) foi fechada abruptamente.")
+            logging.warning(f"Conexão com {address} (usuário: {username}) foi fechada abruptamente.", extra={"category": "conexao", "user": username})
+        except ssl.SSLError as e:
+            logging.warning(f"Erro de TLS com {address} (usuário: {username}): {e}", extra={"category": "conexao", "user": username})
+            if not username: client_socket.close()
         except Exception as e:
             logging.error(f"Erro inesperado com {address} (usuário: {username}): {e}", exc_info=True)
         finally:
-            if username: self.remove_client(client_socket, username)
+            # Conexão estacionada para a troca de processo segue viva no processo novo
+            if username and not parked: self.remove_client(client_socket, username)
 
-    def _authentication_loop(self, client_socket):
+    def _authenticate(self, client_socket):
         client_socket.settimeout(60.0)
         buffer = ""
         while self.running:
@@ -107,21 +188,29 @@ class ChatServer:
                 password = message.get('password', '')
 
                 if action == 'REGISTER':
-                    success, msg = self.register_user(username, password)
+                    with self.profiler.timed('REGISTER'):
+                        success, msg = self.register_user(username, password)
                     self.send_response(client_socket, {"status": "SUCCESS" if success else "ERROR", "message": msg})
                 
                 elif action == 'LOGIN':
-                    with self.clients_lock:
-                        if any(info['username'] == username for info in self.clients.values()):
-                            self.send_response(client_socket, {"status": "ERROR", "message": "Usuário já está online."})
-                            continue
-                    if self.authenticate_user(username, password):
-                        self.send_response(client_socket, {"status": "SUCCESS", "message": "Login bem-sucedido."})
-                        self.add_client(client_socket, username)
-                        client_socket.settimeout(None) # Timeout desativado após login
-                        return username
-                    else:
-                        self.send_response(client_socket, {"status": "ERROR", "message": "Credenciais inválidas."})
+                    # Durante a troca de processo o login iria para o processo que está saindo:
+                    # recusa, e o cliente tenta de novo já no processo novo
+                    with self.loops_lock:
+                        refused = self.draining
+                        if not refused: self.authenticating += 1
+                    if refused:
+                        self.send_response(client_socket, {"status": "ERROR", "message": "Servidor reiniciando, tente novamente."})
+                        return None
+                    accepted = None
+                    try:
+                        accepted = self._login(client_socket, message, username, password)
+                    finally:
+                        # O login aceito passa direto a contar como leitura ativa: hand_off nunca
+                        # vê os dois contadores em zero com a conexão já em self.clients
+                        with self.loops_lock:
+                            self.authenticating -= 1
+                            if accepted: self.active_loops += 1
+                    if accepted: return accepted
             except (json.JSONDecodeError, UnicodeDecodeError):
                 logging.warning("Recebido dado malformado durante autenticação.")
                 continue
@@ -130,33 +219,124 @@ class ChatServer:
                 return None
         return None
 
-    def _message_loop(self, client_socket, username):
-        buffer = ""
+    def _login(self, client_socket, message, username, password):
+        """Retorna o usuário se o login foi aceito; nos demais casos já respondeu o erro."""
+        session_id = message.get('session')
+        old_socket = self.get_client_socket(username)
+        remote = self.remote_users.get(username)
+        online_elsewhere = remote and remote['online'] and not (session_id and remote['session'] == session_id)
+        if (old_socket and not self.is_same_session(username, session_id)) or online_elsewhere:
+            self.send_response(client_socket, {"status": "ERROR", "message": "Usuário já está online."})
+            return None
+        with self.profiler.timed('LOGIN'):
+            authenticated = self.authenticate_user(username, password)
+        if authenticated:
+            if old_socket:
+                logging.info(f"Sessão de {username} retomada em nova conexão.", extra={"category": "conexao", "user": username})
+                self.remove_client(old_socket, username)
+            claimed = self.claim_remote_session(username, remote, message.get('ack', 0)) if remote else None
+            last_seq = self.resume_session(username, session_id, message.get('ack', 0), claimed)
+            # Sob TLS a compressão fica desligada: misturar no mesmo contexto texto de
+            # terceiros e mensagens privadas vaza conteúdo pelo tamanho (ataque CRIME)
+            compression = None if self.tls_context else negotiate(message.get('compression'))
+            self.send_response(client_socket, {"status": "SUCCESS", "message": "Login bem-sucedido.", "ack": last_seq, "compression": compression,
+                                               "file_port": FILE_PORT, "file_token": make_file_token(self.file_secret, username)})
+            if compression:
+                self.codecs[client_socket] = StreamCompressor()
+            self.add_client(client_socket, username)
+            client_socket.settimeout(None) # Timeout desativado após login
+            return username
+        self.send_response(client_socket, {"status": "ERROR", "message": "Credenciais inválidas."})
+        return None
+
+    def _message_loop(self, client_socket, username, buffer=""):
+        """Retorna True se a leitura parou para a troca de processo (ver hand_off).
+        Quem chama já contou a leitura em active_loops (_authenticate ou _submit_reader)."""
+        try:
+            return self._read_messages(client_socket, username, buffer)
+        finally:
+            with self.loops_lock: self.active_loops -= 1
+
+    def _read_messages(self, client_socket, username, buffer):
+        discarding = False  # dentro de uma linha maior que MAX_MESSAGE_SIZE
+        # Um cliente que manda meio registro TLS não pode segurar esta thread no recv
+        if isinstance(client_socket, LockedSSLSocket): client_socket.read_wait = HANDOFF_POLL
         while self.running:
-            data = client_socket.recv(BUFFER_SIZE)
+            # select em vez de timeout no socket: o timeout valeria também para os envios
+            try:
+                # Sob TLS pode haver dados já decifrados no buffer do SSL, invisíveis ao select
+                buffered = isinstance(client_socket, ssl.SSLSocket) and client_socket.pending()
+                if not buffered and not select.select([client_socket], [], [], HANDOFF_POLL)[0]:
+                    if self.draining: return self._park(client_socket, buffer)
+                    continue
+                data = client_socket.recv(BUFFER_SIZE)
+            except socket.timeout:
+                # Registro TLS ainda incompleto: o que chegou fica no SSL para a próxima leitura
+                if self.draining: return self._park(client_socket, buffer)
+                continue
+            except OSError:
+                if client_socket.fileno() == -1: break  # fechado por remove_client (ex.: sessão retomada)
+                raise
             if not data: break
             buffer += data.decode('utf-8')
             while '\n' in buffer:
                 line, buffer = buffer.split('\n', 1)
+                if discarding or len(line) > MAX_MESSAGE_SIZE:
+                    discarding = False
+                    self._reject_oversized(client_socket, username)
+                    continue
                 if not line.strip(): continue
                 message = json.loads(line)
                 self.add_to_queue({'type': 'process_message', 'message': message, 'username': username, 'client_socket': client_socket})
+            if len(buffer) > MAX_MESSAGE_SIZE:
+                # Não acumula a linha gigante: descarta até o próximo '\n'
+                discarding, buffer = True, ""
+            if self.draining: return self._park(client_socket, buffer)
+        return False
+
+    def _submit_reader(self, client_socket, address, username, buffer):
+        """Volta a ler uma conexão já autenticada (herdada ou estacionada)."""
+        with self.loops_lock: self.active_loops += 1
+        self.executor.submit(self.handle_client, client_socket, address, username, buffer)
+
+    def _park(self, client_socket, buffer):
+        # Linha incompleta vai junto para o processo novo continuar a leitura
+        with self.clients_lock:
+            if client_socket not in self.clients: return False
+            self.clients[client_socket]['pending_input'] = buffer
+        return True
+
+    def _reject_oversized(self, client_socket, username):
+        # Não passa pela fila de processamento nem pelo banco: anexos usam o canal de arquivos
+        logging.warning(f"Mensagem de {username} acima de {MAX_MESSAGE_SIZE} bytes descartada.", extra={"category": "envio", "user": username})
+        self.add_to_queue({'type': 'notify', 'client_socket': client_socket,
+                           'message': {"type": "SYSTEM", "message": "Mensagem grande demais. Use o botão Arquivo para enviar anexos."}})
 
     def add_client(self, client_socket, username):
         with self.clients_lock:
             self.clients[client_socket] = {'username': username, 'last_ping': time.time(), 'rooms': {'Geral'}}
         self.rooms['Geral'].add(username)
-        logging.info(f"Usuário {username} entrou no chat.")
+        logging.info(f"Usuário {username} entrou no chat.", extra={"category": "conexao", "user": username})
+        self.publish({"op": "presence", "user": username, "online": True, "session": self.sessions[username]['id']})
         self.add_to_queue({'type': 'broadcast_system', 'message': f"{username} entrou no chat."})
         self.add_to_queue({'type': 'send_user_list_all'})
+        self.add_to_queue({'type': 'replay_unacked', 'username': username})
         self.add_to_queue({'type': 'send_offline_messages', 'username': username})
 
     def process_message_queue(self):
+        since_flush = 0
         while self.running:
             try:
                 item = self.message_queue.get(timeout=1)
                 if item is None: break
                 msg_type = item.get('type')
+                profiling = self.profiler.enabled
+                if profiling:
+                    label = msg_type
+                    if msg_type == 'process_message':
+                        label = item['message'].get('type')
+                        if not isinstance(label, str) or label not in CLIENT_MESSAGE_TYPES: label = "OUTRO"
+                    self.profiler.begin(label, item)
 
                 if msg_type == 'broadcast_system':
                     self.broadcast_system(item['message'])
@@ -164,19 +344,46 @@ class ChatServer:
                     self.send_user_list_all()
                 elif msg_type == 'send_offline_messages':
                     self.send_offline_messages(item['username'])
+                elif msg_type == 'replay_unacked':
+                    self.replay_unacked(item['username'])
                 elif msg_type == 'process_message':
                     self.process_client_message(item['message'], item['username'], item['client_socket'])
+                elif msg_type == 'bus_event':
+                    self.handle_bus_event(item['event'])
+                elif msg_type == 'notify':
+                    self.send_response(item['client_socket'], item['message'])
+                elif msg_type == 'barrier':
+                    # Tudo que estava antes na fila já foi processado: sai junto com a barreira
+                    if self.pending_acks: self.flush_acks()
+                    self.flush_writes()
+                    item['event'].set()
+                if profiling: self.profiler.end()
+
+                # ACKs são agrupados: só saem quando a fila esvazia ou após ACK_DELAY
+                if self.pending_acks and (self.message_queue.empty() or time.time() - self.last_ack_flush >= ACK_DELAY):
+                    self.flush_acks()
             except queue.Empty:
-                continue
+                if self.pending_acks: self.flush_acks()
             except Exception as e:
                 logging.error(f"Erro fatal processando fila: {e}", exc_info=True)
 
+            # Escritas também são agrupadas: o que foi gerado para cada conexão
+            # enquanto havia itens na fila sai numa única escrita vetorizada
+            since_flush += 1
+            if self.pending_writes and (self.message_queue.empty() or since_flush >= WRITE_BATCH):
+                self.flush_writes()
+                since_flush = 0
+            if self.profiler.enabled and not self.pending_writes: self.profiler.flushed()
+
     def process_client_message(self, message, username, client_socket):
         msg_type = message.get("type")
         
         with self.clients_lock:
             if client_socket in self.clients:
                 self.clients[client_socket]['last_ping'] = time.time()
+
+        if not self.accept_sequence(username, message):
+            return
         
         if msg_type == "PING":
             self.send_response(client_socket, {"type": "PONG"})
@@ -184,17 +391,19 @@ class ChatServer:
         # --- CORREÇÃO CRÍTICA ---
         # Adiciona a lógica que faltava para responder ao pedido da lista.
         elif msg_type == "USERLIST":
-            logging.info(f"Atendendo pedido de lista de usuários de '{username}'.")
+            logging.info(f"Atendendo pedido de lista de usuários de '{username}'.", extra={"category": "userlist", "user": username})
             self.send_user_list_all()
             
         elif msg_type == "PUBLIC":
             msg_data = {"type": "PUBLIC", "sender": username, "message": message["message"], "timestamp": datetime.now().strftime('%H:%M:%S')}
+            self.add_attachment(msg_data, message)
             self.broadcast_to_room("Geral", msg_data)
             self.save_message_history("Geral", username, message["message"])
             
         elif msg_type == "PRIVATE":
             recipient = message.get("recipient")
             msg_data = {"type": "PRIVATE", "sender": username, "recipient": recipient, "message": message["message"], "timestamp": datetime.now().strftime('%H:%M:%S')}
+            self.add_attachment(msg_data, message)
             self.send_private(msg_data)
 
         elif msg_type == "ROOM_MESSAGE":
@@ -203,21 +412,46 @@ class ChatServer:
                 is_member = room in self.clients.get(client_socket, {}).get('rooms', set())
             if is_member:
                 msg_data = {"type": "ROOM_MESSAGE", "sender": username, "room": room, "message": msg, "timestamp": datetime.now().strftime('%H:%M:%S')}
+                self.add_attachment(msg_data, message)
                 self.broadcast_to_room(room, msg_data)
                 self.save_message_history(room, username, msg)
         
         elif msg_type in ["TYPING_START", "TYPING_STOP"]:
             recipient = message.get("recipient")
             if recipient:
-                recipient_socket = self.get_client_socket(recipient)
-                if recipient_socket:
-                    status_msg = {"type": "typing", "sender": username, "status": msg_type == "TYPING_START"}
-                    self.send_response(recipient_socket, status_msg)
+                status_msg = {"type": "typing", "sender": username, "status": msg_type == "TYPING_START"}
+                self.send_direct(recipient, status_msg)
+
+        elif msg_type == "PROFILE":
+            self.send_response(client_socket, {"type": "SYSTEM", "message": self.profile_command(username, message.get("action"))})
+
+    def profile_command(self, username, action):
+        if username not in self.admins:
+            return "Comando restrito a administradores."
+        logging.info(f"Comando de profiling '{action}' de {username}.", extra={"category": "perfil", "user": username})
+        if action == "start":
+            return "Profiling ligado." if self.profiler.start() else "O profiling já está ligado."
+        if action == "stop":
+            path = self.profiler.stop()
+            return f"Profiling desligado; resultados em {path}." if path else "O profiling não está ligado."
+        if action == "dump" and self.profiler.enabled:
+            return f"Resultados parciais em {self.profiler.dump()}."
+        return f"Profiling {'ligado' if self.profiler.enabled else 'desligado'}. Ações: start, stop, dump."
 
-    def remove_client(self, client_socket, username):
+    def add_attachment(self, msg_data, message):
+        """Copia a referência do anexo se ele já estiver no repositório de arquivos."""
+        attachment = message.get("attachment")
+        if not isinstance(attachment, dict) or not self.file_server.store.exists(attachment.get("id")): return
+        msg_data["attachment"] = {"id": attachment["id"], "name": os.path.basename(str(attachment.get("name", "arquivo")))[:255],
+                                  "size": self.file_server.store.size(attachment["id"])}
+
+    def remove_client(self, client_socket, username, transfer=False):
+        """Com `transfer` a sessão está indo para outro worker (ver release_session): o
+        usuário continua no chat, então não há aviso de saída nem evento de presença."""
         with self.clients_lock:
             client_info = self.clients.pop(client_socket, None)
             if not client_info: return
+            codec = self.codecs.pop(client_socket, None)
             
             username = username or client_info.get('username')
             if not username: return
@@ -225,37 +459,74 @@ class ChatServer:
             for room_name in list(self.rooms.keys()):
                 if username in self.rooms[room_name]:
                     self.rooms[room_name].discard(username)
+
+            session = self.sessions.get(username)
+            if session: session.update(disconnected_at=time.time(), live=False)
+            self.pending_acks.discard(username)
+        if not transfer:
+            self.publish({"op": "presence", "user": username, "online": False, "session": session['id'] if session else None})
         
-        logging.info(f"Cliente {username} desconectado.")
-        self.add_to_queue({'type': 'broadcast_system', 'message': f"{username} saiu do chat."})
-        self.add_to_queue({'type': 'send_user_list_all'})
+        logging.info(f"Cliente {username} desconectado.", extra={"category": "conexao", "user": username})
+        if codec and codec.bytes_in:
+            logging.info(f"Compressão para {username}: {codec.bytes_in} -> {codec.bytes_out} bytes ({codec.bytes_out / codec.bytes_in:.0%}).",
+                         extra={"category": "conexao", "user": username})
+        if not transfer:
+            self.add_to_queue({'type': 'broadcast_system', 'message': f"{username} saiu do chat."})
+            self.add_to_queue({'type': 'send_user_list_all'})
         try:
             client_socket.shutdown(socket.SHUT_RDWR)
             client_socket.close()
         except OSError:
             pass
 
-    def add_to_queue(self, item): self.message_queue.put(item)
+    def add_to_queue(self, item):
+        if self.profiler.enabled: self.profiler.enqueued(item)
+        self.message_queue.put(item)
     
     def send_response(self, sock, data):
+        self.send_bytes(sock, encode_message(data))
+
+    def send_bytes(self, sock, payload):
+        """Na thread da fila só acumula o frame (ver flush_writes); nas demais escreve na hora."""
+        if threading.current_thread() is self.message_worker:
+            self.pending_writes.setdefault(sock, []).append(payload)
+        else:
+            self._write(sock, [payload])
+
+    def flush_writes(self):
+        pending, self.pending_writes = self.pending_writes, {}
+        for sock, frames in pending.items():
+            self._write(sock, frames)
+
+    def _write(self, sock, frames):
         try:
-            sock.sendall((json.dumps(data) + '\n').encode('utf-8'))
+            codec = self.codecs.get(sock)
+            if codec:
+                # O contexto de compressão é da conexão: comprime o lote inteiro de uma vez
+                frames = [codec.encode(b"".join(frames))]
+            write_frames(sock, frames)
         except (OSError, ConnectionError) as e:
-            logging.warning(f"Falha ao enviar dados: {e}")
+            logging.warning(f"Falha ao enviar dados: {e}", extra={"category": "envio"})
 
     def broadcast(self, message):
+        payload = encode_message(message)
         with self.clients_lock:
             for sock in list(self.clients.keys()):
-                self.send_response(sock, message)
+                self.send_bytes(sock, payload)
 
-    def broadcast_system(self, text): self.broadcast({"type": "SYSTEM", "message": text})
+    def broadcast_system(self, text, propagate=True):
+        message = {"type": "SYSTEM", "message": text}
+        self.broadcast(message)
+        if propagate: self.publish({"op": "publish", "room": None, "message": message})
 
-    def broadcast_to_room(self, room, message):
+    def broadcast_to_room(self, room, message, propagate=True):
         with self.clients_lock:
             user_list = self.rooms.get(room, set())
+            payload = encode_message(message)
             for sock, info in self.clients.items():
                 if info.get('username') in user_list:
-                    self.send_response(sock, message)
+                    self.send_bytes(sock, payload)
+        if propagate: self.publish({"op": "publish", "room": room, "message": message})
 
     def get_client_socket(self, username):
         with self.clients_lock:
@@ -264,12 +535,212 @@ class ChatServer:
                     return sock
         return None
 
-    def send_private(self, message):
-        recipient_socket = self.get_client_socket(message["recipient"])
-        if recipient_socket:
-            self.send_response(recipient_socket, message)
+    def send_private(self, message, propagate=True):
+        recipient = message["recipient"]
+        if self.send_reliable(recipient, message): return
+        if propagate and self.is_remote_online(recipient):
+            self.publish({"op": "deliver", "to": recipient, "message": message})
         else:
             self.save_offline_message(message)
+
+    def send_direct(self, recipient, message, propagate=True):
+        """Entrega sem garantia (ex.: typing): só se o destinatário estiver online."""
+        recipient_socket = self.get_client_socket(recipient)
+        if recipient_socket:
+            self.send_response(recipient_socket, message)
+        elif propagate and self.is_remote_online(recipient):
+            self.publish({"op": "deliver", "to": recipient, "message": message})
+
+    # --- Barramento entre workers (modo multiprocesso) ---
+
+    def publish(self, event):
+        if self.bus: self.bus.send(event)
+
+    def is_remote_online(self, username):
+        remote = self.remote_users.get(username)
+        return bool(remote and remote['online'])
+
+    def handle_bus_event(self, event):
+        op = event.get('op')
+        if op == 'presence':
+            self.update_remote_presence(event)
+        elif op == 'deliver':
+            message = event['message']
+            if message.get('type') == 'PRIVATE':
+                self.send_private(message, propagate=False)
+            else:
+                self.send_direct(event['to'], message, propagate=False)
+        elif op == 'undeliverable':
+            # O destinatário saiu enquanto a mensagem cruzava o barramento
+            if event['message'].get('type') == 'PRIVATE':
+                self.save_offline_message(event['message'])
+        elif op == 'publish':
+            if event.get('room'):
+                self.broadcast_to_room(event['room'], event['message'], propagate=False)
+            else:
+                self.broadcast(event['message'])
+        elif op == 'claim':
+            self.release_session(event)
+
+    def update_remote_presence(self, event):
+        username, worker = event['user'], event['origin']
+        with self.clients_lock:
+            was_online = self.is_remote_online(username)
+            if event.get('online') or event.get('session'):
+                self.remote_users[username] = {'worker': worker, 'online': bool(event.get('online')), 'session': event.get('session')}
+            elif self.remote_users.get(username, {}).get('worker') == worker:
+                del self.remote_users[username]
+            changed = was_online != self.is_remote_online(username)
+        if changed: self.send_user_list_all()
+
+    def claim_remote_session(self, username, remote, ack=0):
+        """Pede ao worker que guarda a sessão do usuário que a libere; devolve os
+        contadores de sequência dela para a reconexão continuar sem duplicatas.
+        `ack` é o último seq que o cliente recebeu, para o outro worker não devolver
+        ao armazenamento offline o que já foi entregue."""
+        reply = self.bus.request({"op": "claim", "user": username, "target": remote['worker'], "ack": ack})
+        if reply is None:
+            logging.warning(f"Worker {remote['worker']} não liberou a sessão de {username} a tempo.", extra={"category": "conexao", "user": username})
+        return reply
+
+    def release_session(self, request):
+        username = request['user']
+        sock = self.get_client_socket(username)
+        if sock: self.remove_client(sock, username, transfer=True)
+        ack = request.get('ack')
+        with self.clients_lock:
+            session = self.sessions.pop(username, None)
+            acked = self._drop_acked(session, ack) if session and isinstance(ack, int) else []
+        reply = {"op": "claimed", "user": username}
+        if session:
+            reply.update(session=session['id'], in_seq=session['in_seq'], out_seq=session['out_seq'])
+            self.mark_offline_delivered(acked)
+            self.persist_unacked(session)
+        # Sem evento de presença: o worker que pediu publica o usuário online logo em seguida
+        self.bus.reply(request, reply)
+        logging.info(f"Sessão de {username} transferida para o worker {request['origin']}.", extra={"category": "conexao", "user": username})
+
+    def is_same_session(self, username, session_id):
+        with self.clients_lock:
+            session = self.sessions.get(username)
+            return bool(session_id) and session is not None and session['id'] == session_id
+
+    def resume_session(self, username, session_id, client_ack, claimed=None):
+        """Associa a conexão à sessão do cliente e retorna o último seq já processado.
+        `claimed` traz os contadores de uma sessão vinda de outro worker."""
+        with self.clients_lock:
+            session = self.sessions.get(username)
+            expired = None
+            if session is None or not session_id or session['id'] != session_id:
+                expired = session
+                # Sessão nova para um cliente que já recebeu até `client_ack` (ex.: o servidor
+                # reiniciou): a numeração continua de lá, senão o cliente descartaria as
+                # próximas mensagens como repetidas e ainda as confirmaria
+                start_seq = client_ack if session_id and isinstance(client_ack, int) and client_ack > 0 else 0
+                session = {'id': session_id, 'in_seq': 0, 'out_seq': start_seq, 'unacked': OrderedDict(), 'disconnected_at': None}
+                if session_id and claimed and claimed.get('session') == session_id:
+                    session.update(in_seq=claimed['in_seq'], out_seq=max(claimed['out_seq'], start_seq))
+                self.sessions[username] = session
+            # Envios ficam no buffer até replay_unacked, para não ultrapassarem o reenvio
+            session['live'] = False
+            session['disconnected_at'] = None
+            acked = self._drop_acked(session, client_ack)
+            last_seq = session['in_seq']
+        if expired: self.persist_unacked(expired)
+        self.mark_offline_delivered(acked)
+        return last_seq
+
+    def _drop_acked(self, session, ack):
+        """Remove do buffer as mensagens confirmadas; retorna os ids offline que foram entregues."""
+        delivered = []
+        unacked = session['unacked']
+        while unacked and next(iter(unacked)) <= ack:
+            _, (_, offline_id) = unacked.popitem(last=False)
+            if offline_id is not None: delivered.append(offline_id)
+        return delivered
+
+    def accept_sequence(self, username, message):
+        """Trata ACKs recebidos e descarta mensagens repetidas após uma reconexão."""
+        seq = message.get("seq")
+        acked, duplicate = [], False
+        with self.clients_lock:
+            session = self.sessions.get(username)
+            if session is None: return True
+            if "ack" in message:
+                acked = self._drop_acked(session, message["ack"])
+            if seq is not None:
+                # Duplicatas também são confirmadas: o cliente pode não ter recebido o ACK anterior
+                self.pending_acks.add(username)
+                duplicate = seq <= session['in_seq']
+                if not duplicate: session['in_seq'] = seq
+        if duplicate: logging.info(f"Mensagem duplicada de {username} (seq {seq}) descartada.", extra={"category": "entrega", "user": username, "seq": seq})
+        self.mark_offline_delivered(acked)
+        return not duplicate
+
+    def flush_acks(self):
+        with self.clients_lock:
+            pending, self.pending_acks = self.pending_acks, set()
+            acks = [(self.get_client_socket(u), self.sessions[u]['in_seq']) for u in pending if u in self.sessions]
+        self.last_ack_flush = time.time()
+        for sock, seq in acks:
+            if sock: self.send_response(sock, {"type": "ACK", "ack": seq})
+
+    def send_reliable(self, username, message, offline_id=None):
+        """Envia com número de sequência e guarda até o ACK; False se não há sessão do destinatário."""
+        with self.clients_lock:
+            session = self.sessions.get(username)
+            if session is None: return False
+            connected = session['live'] and self.get_client_socket(username) is not None
+        if offline_id is None and not connected:
+            # Sem conexão a mensagem ficaria só na memória até a reconexão, e o remetente já
+            # recebeu o ACK: grava antes, e o ACK do destinatário marca como entregue
+            offline_id = self.save_offline_message(message)
+        with self.clients_lock:
+            session = self.sessions.get(username)
+            if session is None: return offline_id is not None
+            session['out_seq'] += 1
+            data = dict(message, seq=session['out_seq'])
+            session['unacked'][data['seq']] = (data, offline_id)
+            sock = self.get_client_socket(username) if session['live'] else None
+        if sock: self.send_response(sock, data)
+        return True
+
+    def replay_unacked(self, username):
+        with self.clients_lock:
+            session = self.sessions.get(username)
+            sock = self.get_client_socket(username)
+            if not session or not sock: return
+            session['live'] = True
+            pending = [data for data, _ in session['unacked'].values()]
+        if not pending: return
+        logging.info(f"Reenviando {len(pending)} mensagem(ns) não confirmada(s) para {username}.", extra={"category": "entrega", "user": username, "count": len(pending)})
+        for data in pending:
+            self.send_response(sock, data)
+
+    def persist_unacked(self, session):
+        """Devolve ao armazenamento offline o que nunca foi confirmado pelo cliente."""
+        for data, offline_id in session['unacked'].values():
+            if offline_id is None:
+                self.save_offline_message(data)
+        session['unacked'].clear()
+
+    def mark_offline_delivered(self, ids):
+        if not ids: return
+        try:
+            with self.profiler.span('persist'), sqlite3.connect(DB_FILE) as conn:
+                conn.executemany("UPDATE offline_messages SET delivered=TRUE WHERE id=?", [(i,) for i in ids])
+        except Exception as e:
+            logging.error(f"Erro ao confirmar msgs offline: {e}")
+
+    def expire_sessions(self):
+        now = time.time()
+        with self.clients_lock:
+            expired = [u for u, s in self.sessions.items()
+                       if s['disconnected_at'] and now - s['disconnected_at'] > SESSION_TTL]
+            sessions = [self.sessions.pop(u) for u in expired]
+        for username, session in zip(expired, sessions):
+            self.persist_unacked(session)
+            self.publish({"op": "presence", "user": username, "online": False, "session": None})
     
     def send_user_list_all(self):
         with self.clients_lock:
@@ -277,6 +748,7 @@ class ChatServer:
                 online_users = set()
             else:
                 online_users = {info['username'] for info in self.clients.values()}
+            online_users.update(u for u, info in self.remote_users.items() if info['online'])
         
         with sqlite3.connect(DB_FILE) as conn:
             all_users = [row[0] for row in conn.execute("SELECT username FROM users ORDER BY username")]
@@ -310,7 +782,7 @@ class ChatServer:
 
     def save_message_history(self, room, sender, message):
         try:
-            with sqlite3.connect(DB_FILE) as conn:
+            with self.profiler.span('persist'), sqlite3.connect(DB_FILE) as conn:
                 conn.execute("INSERT INTO chat_history (room, sender, message, timestamp) VALUES (?, ?, ?, ?)",
                              (room or "Geral", sender, message, datetime.now().strftime('%H:%M:%S')))
         except Exception as e:
@@ -318,52 +790,281 @@ class ChatServer:
 
     def save_offline_message(self, message):
         try:
-            with sqlite3.connect(DB_FILE) as conn:
-                conn.execute("INSERT INTO offline_messages (sender, recipient, message, timestamp) VALUES (?, ?, ?, ?)",
-                             (message["sender"], message["recipient"], message["message"], message["timestamp"]))
+            with self.profiler.span('persist'), sqlite3.connect(DB_FILE) as conn:
+                attachment = json.dumps(message["attachment"]) if message.get("attachment") else None
+                cursor = conn.execute("INSERT INTO offline_messages (sender, recipient, message, timestamp, attachment) VALUES (?, ?, ?, ?, ?)",
+                                      (message["sender"], message["recipient"], message["message"], message["timestamp"], attachment))
+            return cursor.lastrowid
         except Exception as e:
             logging.error(f"Erro ao salvar msg offline: {e}")
+            return None
 
     def send_offline_messages(self, username):
-        client_socket = self.get_client_socket(username)
-        if not client_socket: return
+        # Só são marcadas como entregues quando o cliente confirmar (ver accept_sequence)
+        with self.clients_lock:
+            session = self.sessions.get(username)
+            if not session or not self.get_client_socket(username): return
+            in_flight = {oid for _, oid in session['unacked'].values() if oid is not None}
         with sqlite3.connect(DB_FILE) as conn:
-            cursor = conn.cursor()
-            messages = cursor.execute("SELECT id, sender, message, timestamp FROM offline_messages WHERE recipient=? AND delivered=FALSE", (username,)).fetchall()
-            for msg_id, sender, message, timestamp in messages:
-                self.send_response(client_socket, {"type": "PRIVATE", "sender": sender, "message": f"(Offline) {message}", "timestamp": timestamp})
-                cursor.execute("UPDATE offline_messages SET delivered=TRUE WHERE id=?", (msg_id,))
-            conn.commit()
+            messages = conn.execute("SELECT id, sender, message, timestamp, attachment FROM offline_messages WHERE recipient=? AND delivered=FALSE", (username,)).fetchall()
+        for msg_id, sender, message, timestamp, attachment in messages:
+            if msg_id in in_flight: continue
+            msg_data = {"type": "PRIVATE", "sender": sender, "recipient": username, "message": f"(Offline) {message}", "timestamp": timestamp}
+            if attachment: msg_data["attachment"] = json.loads(attachment)
+            self.send_reliable(username, msg_data, offline_id=msg_id)
 
     def cleanup_connections(self):
         while self.running:
             time.sleep(self.ping_interval)
+            self.expire_sessions()
             with self.clients_lock:
-                if not self.clients: continue
+                # Durante a troca de processo as conexões já estão sendo entregues
+                if not self.clients or self.draining: continue
                 clients_to_remove = []
                 for sock, info in self.clients.items():
                     if time.time() - info.get('last_ping', 0) > self.ping_timeout:
                         clients_to_remove.append((sock, info.get('username')))
             for sock, user in clients_to_remove:
-                logging.warning(f"Timeout de ping para {user}. Desconectando.")
+                logging.warning(f"Timeout de ping para {user}. Desconectando.", extra={"category": "conexao", "user": user})
                 self.remove_client(sock, user)
                 
+    # --- Hot restart: troca de processo sem derrubar as conexões ---
+
+    def start_handoff_listener(self):
+        if not handoff_supported():
+            logging.warning("Troca de processo sem queda indisponível: requer sockets Unix e SCM_RIGHTS.")
+            return
+        # O processo antigo ainda escuta no caminho antigo até sair; este assume o nome
+        if os.path.exists(self.handoff_path): os.unlink(self.handoff_path)
+        self.handoff_listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.handoff_listener.bind(self.handoff_path)
+        # Quem conecta aqui leva todas as conexões: só o próprio usuário (ver _handoff_loop)
+        os.chmod(self.handoff_path, 0o600)
+        self.handoff_listener.listen(1)
+        threading.Thread(target=self._handoff_loop, name="HandoffThread", daemon=True).start()
+
+    def _handoff_loop(self):
+        while self.running:
+            try:
+                conn, _ = self.handoff_listener.accept()
+            except OSError:
+                break
+            with conn:
+                uid = peer_uid(conn)
+                if uid is not None and uid != os.getuid():
+                    logging.warning(f"Pedido de troca de processo recusado: usuário {uid} não é o dono do servidor.")
+                    continue
+                self.hand_off(conn)
+            if self.handed_off: break
+
+    def hand_off(self, conn):
+        """Entrega socket de escuta, conexões e sessões ao processo novo e encerra este."""
+        logging.info("Processo novo pediu a troca; drenando conexões.")
+        with self.loops_lock: self.draining = True  # daqui em diante logins novos são recusados
+        try:
+            if not self._wait_for(lambda: self.authenticating == 0, HANDOFF_WAIT):
+                raise TimeoutError("logins em andamento não terminaram a tempo")
+            if not self._wait_for(lambda: self.active_loops == 0, HANDOFF_WAIT):
+                raise TimeoutError("leituras não pararam a tempo")
+            barrier = threading.Event()
+            self.add_to_queue({'type': 'barrier', 'event': barrier})
+            if not barrier.wait(HANDOFF_WAIT):
+                raise TimeoutError("fila de mensagens não esvaziou a tempo")
+            state, fds = self.capture_state()
+            send_state(conn, state, fds)
+            if not wait_ack(conn):
+                raise ConnectionError("processo novo não confirmou")
+        except (OSError, TimeoutError, ConnectionError) as e:
+            logging.error(f"Troca de processo falhou, este processo continua atendendo: {e}")
+            self.resume_after_handoff()
+            return
+        self.handed_off = True
+        logging.info(f"{len(state['clients'])} conexão(ões) entregue(s) ao processo novo; encerrando.")
+        self.running = False
+
+    def _wait_for(self, condition, timeout):
+        deadline = time.time() + timeout
+        while not condition():
+            if time.time() > deadline: return False
+            time.sleep(0.05)
+        return True
+
+    def capture_state(self):
+        """Estado que o processo novo precisa para continuar as sessões sem novo login.
+        Os descritores seguem a ordem: escuta, arquivos e um por cliente."""
+        with self.clients_lock:
+            # O estado do TLS fica na memória deste processo e não segue com o descritor:
+            # essas conexões são fechadas e os clientes reconectam retomando a sessão do chat
+            socks = [s for s in self.clients if not isinstance(s, ssl.SSLSocket)]
+            now = time.time()
+            for sock, info in self.clients.items():
+                session = self.sessions.get(info['username'])
+                if sock not in socks and session: session.update(disconnected_at=now, live=False)
+            clients = []
+            for sock in socks:
+                info = self.clients[sock]
+                try: address = sock.getpeername()
+                except OSError: address = None
+                clients.append({'username': info['username'], 'address': address, 'last_ping': info['last_ping'],
+                                'rooms': sorted(info['rooms']), 'buffer': info.get('pending_input', ''),
+                                'compressed': sock in self.codecs})
+            sessions = {u: {'id': s['id'], 'in_seq': s['in_seq'], 'out_seq': s['out_seq'], 'live': s['live'],
+                            'disconnected_at': s['disconnected_at'],
+                            'unacked': [[seq, data, offline_id] for seq, (data, offline_id) in s['unacked'].items()]}
+                        for u, s in self.sessions.items()}
+            state = {'file_secret': self.file_secret.hex(), 'clients': clients, 'sessions': sessions,
+                     'rooms': {room: sorted(users) for room, users in self.rooms.items()},
+                     'pending_acks': sorted(self.pending_acks)}
+        fds = [self.server_socket.fileno(), self.file_server.server_socket.fileno()] + [s.fileno() for s in socks]
+        return state, fds
+
+    def adopt(self, state, fds):
+        """Lado do processo novo: assume os sockets e o estado recebidos em hand_off."""
+        self.server_socket.close()
+        self.server_socket = socket.socket(fileno=fds[0])
+        self.file_server.server_socket.close()
+        self.file_server.server_socket = socket.socket(fileno=fds[1])
+        self.file_secret = self.file_server.secret = bytes.fromhex(state['file_secret'])
+        self.adopted_listener = True
+        self.rooms = {room: set(users) for room, users in state['rooms'].items()}
+        self.pending_acks = set(state['pending_acks'])
+        for username, s in state['sessions'].items():
+            unacked = OrderedDict((seq, (data, offline_id)) for seq, data, offline_id in s.pop('unacked'))
+            self.sessions[username] = dict(s, unacked=unacked)
+        for info, fd in zip(state['clients'], fds[2:]):
+            sock = socket.socket(fileno=fd)
+            sock.setblocking(True)
+            self.clients[sock] = {'username': info['username'], 'last_ping': info['last_ping'], 'rooms': set(info['rooms'])}
+            if info['compressed']:
+                # O stream do antigo terminou num Z_SYNC_FLUSH, então blocos de um contexto
+                # novo continuam válidos para o descompressor do cliente (só sem o histórico)
+                self.codecs[sock] = StreamCompressor()
+            address = tuple(info['address']) if info['address'] else None
+            self.adopted.append((sock, address, info['username'], info['buffer']))
+        logging.info(f"Estado recebido do processo antigo: {len(self.clients)} conexão(ões), {len(self.sessions)} sessão(ões).")
+
+    def resume_after_handoff(self):
+        """A troca falhou: volta a ler as conexões estacionadas e a aceitar novas."""
+        with self.clients_lock:
+            parked = [(sock, info['username'], info.pop('pending_input')) for sock, info in self.clients.items() if 'pending_input' in info]
+        self.draining = False
+        for sock, username, buffer in parked:
+            self._submit_reader(sock, None, username, buffer)
+
     def stop_server(self):
         self.running = False
         if self.message_worker.is_alive(): self.message_queue.put(None)
         with self.clients_lock:
             for sock in list(self.clients.keys()):
-                try: sock.close()
+                try:
+                    # shutdown acorda as threads paradas em recv; só close não acorda.
+                    # Após a troca as conexões são do processo novo: fecha só a cópia local
+                    if not self.handed_off or isinstance(sock, ssl.SSLSocket): sock.shutdown(socket.SHUT_RDWR)
+                    sock.close()
                 except: pass
+        with self.clients_lock:
+            sessions, self.sessions = list(self.sessions.values()), {}
+        if not self.handed_off:
+            for session in sessions:
+                self.persist_unacked(session)
         self.executor.shutdown(wait=False)
         self.server_socket.close()
-        logging.info("Servidor parado.")
+        self.file_server.close()
+        if self.handoff_listener:
+            self.handoff_listener.close()
+            self.handoff_listener = None
+            if not self.handed_off and os.path.exists(self.handoff_path): os.unlink(self.handoff_path)
+        if self.bus: self.bus.close()
+        if self.tls_context:
+            stats = self.tls_context.session_stats()
+            logging.info(f"Handshakes TLS: {stats['accept_good']}, dos quais {stats['hits']} retomado(s).")
+        logging.info("Servidor parado." if not self.handed_off else "Servidor antigo encerrado após a troca.")
 
-if __name__ == "__main__":
-    server = ChatServer()
+def takeover(path=HANDOFF_SOCKET, tls_context=None, admins=()):
+    """Sobe um servidor que assume as conexões do que está rodando (hot restart)."""
+    server = ChatServer(handoff_path=path, tls_context=tls_context, admins=admins)
+    conn, state, fds = receive_state(path)
+    with conn:
+        server.adopt(state, fds)
+        conn.sendall(HANDOFF_ACK)
+    return server
+
+def _raise_interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+def install_profile_signal(server):
+    # SIGUSR1 liga/desliga o profiling (em modo multiprocesso, mande para o PID do worker)
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, server.profiler.handle_signal)
+
+def make_tls_context(tls):
+    """`tls` = (certificado, chave, cifras), ou None para texto puro."""
+    return server_context(*tls) if tls else None
+
+def run_worker(worker_id, bus_path, file_secret, tls=None, admins=()):
+    # Quem encerra os workers é o processo principal (SIGTERM); o Ctrl+C vai só para ele
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, _raise_interrupt)
+    log_listener = setup_logging(log_file=f"chat_server-{worker_id}.log")
+    # Cada worker cria seu contexto TLS: tickets emitidos por um worker só são aceitos por ele
+    server = ChatServer(reuse_port=True, bus_path=bus_path, worker_id=worker_id, file_secret=file_secret, tls_context=make_tls_context(tls), admins=admins)
+    install_profile_signal(server)
     try:
         server.start_server()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop_server()
+        log_listener.stop()
+
+def run_cluster(workers, tls=None, admins=()):
+    """Sobe o broker do barramento neste processo e N workers dividindo a porta."""
+    if not hasattr(socket, 'SO_REUSEPORT') or not hasattr(socket, 'AF_UNIX'):
+        raise SystemExit("O modo multiprocesso requer SO_REUSEPORT e sockets Unix (Linux/BSD/macOS).")
+    broker = BusBroker(BUS_SOCKET)
+    threading.Thread(target=broker.serve_forever, name="BusBrokerThread", daemon=True).start()
+    file_secret = secrets.token_bytes(32)
+    processes = [multiprocessing.Process(target=run_worker, args=(i, BUS_SOCKET, file_secret, tls, admins), name=f"Worker-{i}") for i in range(workers)]
+    for process in processes: process.start()
+    logging.info(f"{workers} workers iniciados em {SERVER_HOST}:{SERVER_PORT}")
+    try:
+        for process in processes: process.join()
     except KeyboardInterrupt:
         logging.info("Servidor interrompido pelo usuário.")
     finally:
-        server.stop_server()
\ No newline at end of file
+        for process in processes:
+            if process.is_alive(): process.terminate()
+        for process in processes:
+            process.join(timeout=5)
+        broker.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Servidor do chat")
+    parser.add_argument("--workers", type=int, default=1, help="processos dividindo a porta (SO_REUSEPORT)")
+    parser.add_argument("--takeover", action="store_true", help="assume as conexões do servidor em execução (hot restart)")
+    parser.add_argument("--tls-cert", help="certificado PEM; liga o TLS no chat e no canal de arquivos")
+    parser.add_argument("--tls-key", help="chave privada PEM (se não estiver no arquivo do certificado)")
+    parser.add_argument("--tls-ciphers", help="cifras aceitas no TLS 1.2, na sintaxe do OpenSSL")
+    parser.add_argument("--admin", nargs="+", default=[], help="usuários que podem usar comandos de administração (profiling)")
+    args = parser.parse_args()
+    if args.takeover and args.workers > 1:
+        parser.error("--takeover só funciona com um processo.")
+    tls = (args.tls_cert, args.tls_key, args.tls_ciphers) if args.tls_cert else None
+
+    log_listener = setup_logging()
+    if args.workers > 1:
+        try:
+            run_cluster(args.workers, tls, args.admin)
+        finally:
+            log_listener.stop()
+    else:
+        tls_context = make_tls_context(tls)
+        server = takeover(tls_context=tls_context, admins=args.admin) if args.takeover else ChatServer(handoff_path=HANDOFF_SOCKET, tls_context=tls_context, admins=args.admin)
+        install_profile_signal(server)
+        try:
+            server.start_server()
+        except KeyboardInterrupt:
+            logging.info("Servidor interrompido pelo usuário.")
+        finally:
+            server.stop_server()
+            log_listener.stop()
\ No newline at end of file
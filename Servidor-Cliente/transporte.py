@@ -0,0 +1,50 @@
+import json
+import socket
+import ssl
+from collections import deque
+
+HAS_SENDMSG = hasattr(socket.socket, 'sendmsg')  # não existe no Windows
+IOV_MAX = 512  # buffers por chamada de sendmsg (o Linux aceita até 1024)
+MAX_MESSAGE_SIZE = 16 * 1024  # bytes por linha; arquivos vão pelo canal de arquivos
+SEQ_OVERHEAD = 48  # folga para os campos seq/ack que o cliente acrescenta depois
+
+
+def encode_message(data):
+    """Serializa uma mensagem do protocolo (JSON + '\\n'). O resultado é imutável
+    e pode ser compartilhado entre todos os destinatários de um broadcast."""
+    return (json.dumps(data) + '\n').encode('utf-8')
+
+
+def fits_message(data):
+    """Se a mensagem, já com seq e ack, cabe numa linha do protocolo."""
+    return len(encode_message(data)) + SEQ_OVERHEAD <= MAX_MESSAGE_SIZE
+
+
+def enable_nodelay(sock):
+    # O servidor já agrupa as mensagens pendentes antes de escrever; deixar o
+    # Nagle ligado só atrasaria o último pedaço de cada rajada à espera de ACK.
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except OSError:
+        pass
+
+
+def write_frames(sock, frames):
+    """Escreve todos os frames com o mínimo de syscalls (sendmsg vetorizado)."""
+    # SSLSocket não tem sendmsg; lá o join vira um único registro TLS de qualquer forma
+    if len(frames) == 1 or not HAS_SENDMSG or isinstance(sock, ssl.SSLSocket):
+        sock.sendall(b"".join(frames) if len(frames) > 1 else frames[0])
+        return
+    views = deque(memoryview(f) for f in frames)
+    while views:
+        batch = [views[i] for i in range(min(len(views), IOV_MAX))]
+        sent = sock.sendmsg(batch)
+        # Escrita parcial: descarta o que já saiu e continua do ponto exato
+        while sent:
+            head = views[0]
+            if sent >= len(head):
+                sent -= len(head)
+                views.popleft()
+            else:
+                views[0] = head[sent:]
+                sent = 0